@@ -2,15 +2,53 @@
 # -*- coding: utf-8 -*-
 __author__ = 'QAQAutoMaton'
 
+from wbot import startup
 from os import path
+import argparse
 import nonebot
 import config
 
-if __name__ == '__main__':
+
+def load():
     nonebot.init(config)
+    startup.mark('nonebot.init')
     #nonebot.load_builtin_plugins()
     nonebot.load_plugins(
         path.join(path.dirname(__file__), 'wbot', 'plugins'),
         'wbot.plugins'
     )
-    nonebot.run(host='127.0.0.1', port=8080)
+    startup.mark('plugins')
+
+
+if __name__ == '__main__':
+    startup.mark('imports')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int,
+                        default=getattr(config, 'WEREWOLF_SHARDS', 1),
+                        help='run this many worker processes behind a supervisor')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print a cProfile report of init and plugin loading')
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    host = getattr(config, 'HOST', '127.0.0.1')
+    port = getattr(config, 'PORT', 8080)
+
+    if args.shards > 1 and args.shard is None:
+        from wbot.supervisor import supervise
+        supervise(path.abspath(__file__), args.shards, host, port,
+                  getattr(config, 'WEREWOLF_SEAT_INDEX_PATH', 'werewolf.seats'),
+                  getattr(config, 'WEREWOLF_SEAT_POLL_INTERVAL', 0.1))
+    else:
+        if args.shard is not None:
+            config.WEREWOLF_SHARD = (args.shard, args.shards)
+        if args.profile_startup:
+            startup.profile(load)
+        else:
+            load()
+
+        @nonebot.on_startup
+        async def serving():
+            startup.mark('serving')
+            nonebot.logger.info(startup.report())
+        nonebot.run(host=host, port=args.port or port)
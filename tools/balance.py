@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Estimates the good camp's win rate of rule sets by Monte Carlo, as #balance
+does, spread over a process pool. Rules come from the bot's database, or
+are given inline as name:camp pairs.
+
+    python tools/balance.py 预女猎白 --games 200000 --workers 4
+    python tools/balance.py --all --db werewolf.db
+    python tools/balance.py --roles 预言家:1,女巫:1,平民:1,平民:1,狼人:2,狼人:2
+"""
+__author__ = 'QAQAutoMaton'
+
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import argparse
+import random
+import sys
+import time
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from wbot.werewolf import balance
+from wbot.werewolf.rules import RuleCache
+from wbot.werewolf.storage import Repository
+
+
+def load_rules(db):
+    repo = Repository(db)
+    repo.prepare()
+    rules = RuleCache()
+    rules.load(*repo.run_sync(Repository._load_rules))
+    return rules
+
+
+def estimate(pool, identities, games, workers, rnd):
+    chunks = [games // workers + (i < games % workers) for i in range(workers)]
+    futures = [pool.submit(balance.simulate, identities, chunk, rnd.randrange(2**32))
+               for chunk in chunks if chunk]
+    return sum(f.result() for f in futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('rule', nargs='?', help='rule name or alias in the database')
+    parser.add_argument('--all', action='store_true', help='every rule in the database')
+    parser.add_argument('--roles', help='name:camp,... instead of a rule from the database')
+    parser.add_argument('--db', default=path.join(ROOT, 'werewolf.db'))
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.roles:
+        boards = [(args.roles, tuple((name, int(camp)) for name, camp in
+                                     (one.split(':') for one in args.roles.split(','))))]
+    elif args.rule or args.all:
+        rules = load_rules(args.db)
+        if args.all:
+            boards = [(rules.aliases(rule_id)[0], identities)
+                      for rule_id, identities in sorted(rules.identity.items())]
+        elif rules.find(args.rule) is None:
+            parser.error(f"no rule {args.rule} in {args.db}")
+        else:
+            boards = [(args.rule, rules.identities(rules.find(args.rule)))]
+    else:
+        parser.error("give a rule, --all or --roles")
+    print("numpy" if balance.numpy is not None else "pure Python (numpy is not installed)")
+    rnd = random.Random(args.seed)
+    with ProcessPoolExecutor(args.workers) as pool:
+        for name, identities in boards:
+            begin = time.perf_counter()
+            wins = estimate(pool, identities, args.games, args.workers, rnd)
+            print(balance.report(name, wins, args.games).splitlines()[0] +
+                  f" [{time.perf_counter() - begin:.2f}s]")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pieces shared by the test tools: the board they play, the admin they act
+as, seeding a fresh werewolf.db with it, and picking who speaks next.
+"""
+__author__ = 'QAQAutoMaton'
+
+from os import path
+import random
+import sys
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOARD = [('预言家', 1), ('女巫', 1), ('猎人', 1), ('平民', 1),
+         ('平民', 1), ('狼人', 2), ('狼人', 2), ('狼人', 2)]
+RULE = ('压测', BOARD)
+ADMIN = 1
+
+
+def seed_rules(db_path, rules=(RULE,)):
+    """Creates the database at db_path with (name, identities) rules in it."""
+    from wbot.werewolf.storage import Repository
+    repo = Repository(db_path)
+    repo.prepare()
+    for rule in rules:
+        repo.run_sync(Repository._add_rule, *rule)
+    repo.close()
+
+
+def pick_user(users, groups, i, spread=len(BOARD) + 3):
+    """Who speaks in the i-th of groups groups."""
+    # each group mostly hears from its own regulars, with some players roaming
+    if random.random() < 0.9:
+        return users[(i * len(users) // groups + random.randrange(spread)) % len(users)]
+    return random.choice(users)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drives random games straight through wbot.werewolf.core, without nonebot or
+any I/O, and checks every table's invariants after each event. On an
+exception or a broken invariant it prints the seed and the last events.
+
+    python tools/fuzz.py --events 200000 --seed 1
+"""
+__author__ = 'QAQAutoMaton'
+
+from collections import deque
+from os import path
+import argparse
+import random
+import sys
+import time
+import traceback
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from wbot.werewolf.core import COMMANDS, Core, Event
+from wbot.werewolf.rules import AliasIndex, RuleCache, bigrams
+from common import ADMIN, BOARD, pick_user
+
+RULES = (
+    ('judge8', BOARD),
+    ('auto6', [('预言家', 1), ('女巫', 1), ('守卫', 1), ('猎人', 1),
+               ('狼人', 2), ('狼人', 2)]),
+    ('hidden5', [('预言家', 1), ('平民', 1), ('平民', 1), ('狼人', 2), ('狼王', 3)]),
+)
+VERBS = ('杀', '验', '守', '救', '毒', '开枪', '过', 'x')
+ROLE_VERBS = {'狼人': ('杀',), '预言家': ('验',), '守卫': ('守',),
+              '女巫': ('救', '毒', '过'), '猎人': ('过',)}
+KINDS = {'reply': 2, 'group': 3, 'private': 3, 'deal': 3, 'record': 7,
+         'mark': 2, 'log': 3, 'arm': 2, 'disarm': 2}
+
+
+def check_table(group_id, g, in_game):
+    """Broken invariants of one table, as messages."""
+    errors = []
+    seat = {uid: pos for pos, uid in enumerate(g.player) if uid != 0}
+    if seat != g.seat:
+        errors.append(f"{group_id}: seat map {g.seat} != players {seat}")
+    if g.player_num and g.free != list(g.player).count(0):
+        errors.append(f"{group_id}: free {g.free} != {list(g.player).count(0)}")
+    if g.player_num and g.alive_count != sum(g.alive[1:]):
+        errors.append(f"{group_id}: alive_count {g.alive_count}")
+    if g.running and sorted(g.identity) != list(range(g.player_num)):
+        errors.append(f"{group_id}: identity {list(g.identity)}")
+    r = g.round
+    if r is not None:
+        if set(r.pending) & set(r.ballot):
+            errors.append(f"{group_id}: voter both pending and voted")
+        for target, voters in r.buckets.items():
+            if abs(r.tally[target] - sum(r.weight(one) for one in voters)) > 1e-9:
+                errors.append(f"{group_id}: tally of {target}")
+        if any(not g.alive[one] for one in r.pending):
+            errors.append(f"{group_id}: dead seat still to vote")
+    m = g.auto
+    if m is not None:
+        if g.player[0] != 0:
+            errors.append(f"{group_id}: judge seat taken at an auto table")
+        if g.running and m.phase is None:
+            errors.append(f"{group_id}: running without a phase")
+        if not g.running and m.phase is not None:
+            errors.append(f"{group_id}: phase {m.phase} before the game")
+        if g.running and (m.phase == 'vote') != (g.round is not None):
+            errors.append(f"{group_id}: phase {m.phase} with round {g.round}")
+    for uid in g.seat:
+        if in_game.get(uid) != group_id:
+            errors.append(f"{uid} seated in {group_id} but in_game says {in_game.get(uid)}")
+    return errors
+
+
+def check(game, in_game):
+    """Broken invariants of every table in game and of the in_game map, as messages."""
+    errors = []
+    seated = {}
+    for group_id, g in game.items():
+        errors += check_table(group_id, g, in_game)
+        for uid in g.seat:
+            if uid in seated:
+                errors.append(f"{uid} seated in {seated[uid]} and {group_id}")
+            seated[uid] = group_id
+    for uid, group_id in in_game.items():
+        if seated.get(uid) != group_id:
+            errors.append(f"in_game[{uid}]={group_id} but seated in {seated.get(uid)}")
+    return errors
+
+
+def dice(a, b):
+    a, b = bigrams(a), bigrams(b)
+    return 2*len(a & b) / (len(a) + len(b))
+
+
+def check_aliases(names, queries, limit=5, floor=0.0):
+    """Where AliasIndex.search disagrees with scoring every name (sharing a bigram), as messages."""
+    errors = []
+    index = AliasIndex(names)
+    for query in queries:
+        found = index.search(query, limit, floor)
+        expected = sorted((score, name) for name in set(names)
+                          for score in (dice(query, name),) if score and score >= floor)[::-1][:limit]
+        # ties may pick other names, the scores must match
+        if [score for score, _ in found] != [score for score, _ in expected] or \
+                any(score != dice(query, name) for score, name in found):
+            errors.append(f"search({query!r}, {limit}, {floor}) = {found}, expected {expected}")
+    return errors
+
+
+def random_aliases(n, alphabet='预女猎白狼守12人AZ'):
+    return [''.join(random.choice(alphabet) for _ in range(random.randint(1, 8)))
+            for _ in range(n)]
+
+
+class Fuzzer:
+    def __init__(self, groups, users, order=0.8):
+        rules = RuleCache()
+        for i, (name, identities) in enumerate(RULES):
+            rules.add(i + 1, name, identities)
+        self.core = Core({}, {}, rules)
+        self.groups = [100000 + i for i in range(groups)]
+        self.users = [200000 + i for i in range(users)]
+        self.order = order
+        self.armed = set()
+        self.games = 0
+        self.effects = 0
+
+    def user(self, i):
+        return pick_user(self.users, len(self.groups), i)
+
+    def newcomer(self):
+        while True:
+            uid = random.choice(self.users)
+            if uid not in self.core.in_game:
+                return uid
+
+    def directed(self, group_id, g):
+        """A move that pushes the table towards the end of a game, as players would."""
+        if g is None or not g.seat:
+            auto = random.random() < 0.5
+            return Event('set', group_id, self.newcomer(),
+                         f"{random.choice(RULES)[0]} {int(auto)}{' auto' if auto else ''}")
+        if not g.running:
+            if g.full():
+                return Event('start', group_id, random.choice(list(g.seat)))
+            free = [i for i in range(0 if g.auto is None else 1, g.player_num + 1)
+                    if g.player[i] == 0]
+            return Event('sit', group_id, self.newcomer(), str(random.choice(free)))
+        alive = g.alive_seats() or [0]
+        target = random.choice(alive)
+        m = g.auto
+        if g.onVote:
+            voters = g.round.not_voted()
+            if voters and random.random() < 0.9:
+                return Event('vote', None, g.player[random.choice(voters)],
+                             str(random.choice((0, target))))
+            if m is None:
+                return Event('vote', group_id, g.player[0], 'end')
+        if m is None:
+            if random.random() < 0.05:
+                return Event('stop', group_id, g.player[0], random.choice(('好人', '狼人', '')))
+            return Event(*random.choice((('kill', group_id, g.player[0], str(target)),
+                                         ('vote', group_id, g.player[0], 'start'),
+                                         ('vote', group_id, g.player[0], 'pk'))))
+        if random.random() < 0.2:
+            return ('expire', group_id, m.step)
+        if m.phase == 'hunter':
+            return Event('act', None, g.player[m.hunter],
+                         random.choice(('开枪', '过')) + f" {target}")
+        seat = random.choice(alive)
+        verb = random.choice(ROLE_VERBS.get(g.role[g.identity[seat-1]][0], ('过',)))
+        return Event('act', None, g.player[seat], f"{verb} {target}")
+
+    def event(self):
+        i = random.randrange(len(self.groups))
+        group_id = self.groups[i]
+        g = self.core.game.get(group_id)
+        if random.random() < self.order:
+            return self.directed(group_id, g)
+        if random.random() < 0.05 and group_id in self.armed and g is not None and g.auto:
+            step = g.auto.step if random.random() < 0.9 else g.auto.step - 1
+            return ('expire', group_id, step)
+        pos = random.randint(-1, 9)
+        uid = self.user(i)
+        if g is not None and g.running and random.random() < 0.5:
+            # players of a running game mostly act on it
+            uid = random.choice(list(g.seat) or [uid])
+            if random.random() < 0.6:
+                text = random.choice(VERBS) + f" {pos}"
+                return Event('act', None, uid, text)
+            return Event('vote', None, uid, str(pos))
+        level = 1 if uid == ADMIN or random.random() < 0.05 else 0
+        name, text = random.choice((
+            ('set', f"{random.choice(RULES)[0]} {pos}" +
+             random.choice(('', '', ' auto', ' x'))), ('set', ''),
+            ('sit', str(pos)), ('sit', str(pos)), ('sit', str(pos)),
+            ('sit', str(pos)), ('sit', 'x'), ('stand', ''), ('status', ''),
+            ('start', ''), ('start', ''), ('resend', ''), ('remake', ''),
+            ('stop', random.choice(('', '好人', '狼', '--force'))),
+            ('kick', str(pos)), ('kickall', random.choice(('', '--force'))),
+            ('kill', str(pos)), ('vote', 'start'), ('vote', 'end'),
+            ('vote', 'pk'), ('vote', f'sheriff {pos}'), ('act', 'x')))
+        if random.random() < 0.2:
+            # the judge drives judged games
+            uid = g.player[0] if g is not None and len(g.player) and g.player[0] else uid
+        return Event(name, group_id, uid, text, level)
+
+    def apply(self, effects):
+        for effect in effects:
+            assert effect[0] in KINDS and len(effect) == KINDS[effect[0]], effect
+            kind = effect[0]
+            if kind == 'arm':
+                self.armed.add(effect[1])
+            elif kind == 'disarm':
+                self.armed.discard(effect[1])
+            elif kind == 'record':
+                self.games += 1
+            elif kind == 'deal':
+                failed = [uid for uid, _ in effect[2] if random.random() < 0.02]
+                self.apply(self.core.undelivered(effect[1], failed))
+        self.effects += len(effects)
+
+    def step(self):
+        """Runs one random event, returns it and the table it went to."""
+        event = self.event()
+        if isinstance(event, tuple):
+            table = event[1]
+            self.apply(self.core.expire(table, event[2]))
+        else:
+            table = event.group_id or self.core.in_game.get(event.user_id)
+            self.apply(self.core.handle(event))
+        return event, table
+
+
+def describe(event):
+    if isinstance(event, tuple):
+        return f"expire {event[1]} step {event[2]}"
+    return f"{event.command} {event.text!r} from {event.user_id} in {event.group_id} (level {event.level})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--order', type=float, default=0.8,
+                        help='share of events that move a game forward, the rest are random')
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--check-every', type=int, default=1000,
+                        help='events between checks of every table, the touched one is checked after each')
+    parser.add_argument('--alias-checks', type=int, default=200,
+                        help='random alias sets to check fuzzy search on against brute force')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    seed = args.seed if args.seed is not None else random.randrange(10**9)
+    random.seed(seed)
+    # parts of every size but the best one's ranked ahead of it
+    errors = check_aliases([f"预女猎{c}" for c in "ABCDEFGHIJ"] + ["Z", "预女猎白12人"],
+                           ["预女猎白"], 1)
+    for _ in range(args.alias_checks):
+        errors += check_aliases(random_aliases(random.randint(1, 60)), random_aliases(10),
+                                random.randint(1, 8), random.choice((0.0, 0.3, 0.5)))
+    if errors:
+        print(f"seed {seed}, fuzzy search:")
+        for one in errors[:20]:
+            print("  " + one)
+        sys.exit(1)
+    fuzzer = Fuzzer(args.groups, args.users, args.order)
+    history = deque(maxlen=20)
+    begin = time.perf_counter()
+    for n in range(1, args.events + 1):
+        try:
+            event, table = fuzzer.step()
+            history.append(event)
+            game, in_game = fuzzer.core.game, fuzzer.core.in_game
+            if n % args.check_every == 0:
+                errors = check(game, in_game)
+            elif table in game:
+                errors = check_table(table, game[table], in_game)
+            else:
+                errors = []
+        except Exception:
+            errors = traceback.format_exc().splitlines()
+        if errors:
+            print(f"seed {seed}, event {n}:")
+            for one in errors[-20:]:
+                print("  " + one)
+            print("last events:")
+            for one in history:
+                print("  " + describe(one))
+            sys.exit(1)
+    elapsed = time.perf_counter() - begin
+    print(f"seed {seed}: {args.events} events in {elapsed:.2f}s ({args.events / elapsed:.0f}/s), "
+          f"{fuzzer.games} games finished ({fuzzer.games / elapsed:.0f}/s), "
+          f"{fuzzer.effects} effects, {len(COMMANDS)} commands")
+    print("consistent")
+
+
+if __name__ == '__main__':
+    main()
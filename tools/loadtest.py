@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs bot.py against a local stand-in for go-cqhttp and replays scripted
+werewolf games (set/sit/start/vote/kill/stop) in many groups at once, then
+reports command latency percentiles, messages per second and the bot's
+event loop lag.
+
+    python tools/loadtest.py --groups 50 --games 3
+
+The bot runs in its own process from a temporary directory holding a
+generated config.py and a seeded werewolf.db; the stand-in connects to it
+over reverse websocket exactly like go-cqhttp does and answers every API
+call after --latency seconds.
+"""
+__author__ = 'QAQAutoMaton'
+
+from os import path
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import runpy
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (AcceptConnection, CloseConnection, Ping,
+                            RejectConnection, Request, TextMessage)
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import ADMIN, RULE, seed_rules
+
+SELF_ID = 10000
+CONFIG = '''from nonebot.default_config import *
+
+COMMAND_START = {{'#'}}
+PORT = {port}
+WEREWOLF_ADMINS = [{admin}]
+WEREWOLF_SEND_RATE = {rate}
+WEREWOLF_GROUP_SEND_RATE = {group_rate}
+WEREWOLF_GROUP_SEND_BURST = {group_burst}
+WEREWOLF_DEAL_RATE = {rate}
+'''
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p / 100))]
+
+
+def serve_bot(port, interval):
+    """Child process: run bot.py unchanged, plus a loop lag probe."""
+    sys.path.insert(0, os.getcwd())
+    import nonebot
+    lag = []
+
+    async def probe():
+        while True:
+            begin = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag.append(time.perf_counter() - begin - interval)
+
+    def run(*args, **kwargs):
+        bot = nonebot.get_bot()
+        task = []
+
+        @bot.server_app.before_serving
+        async def start_probe():
+            task.append(asyncio.ensure_future(probe()))
+
+        @bot.server_app.after_serving
+        async def dump_lag():
+            task[0].cancel()
+            with open('lag.json', 'w') as f:
+                json.dump(lag, f)
+        kwargs.update(host='127.0.0.1', port=port)
+        original(*args, **kwargs)
+
+    original = nonebot.run
+    nonebot.run = run
+    sys.argv = [path.join(ROOT, 'bot.py')]
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+
+class FakeCQHttp:
+    """The go-cqhttp side of a reverse websocket: posts events, answers API calls."""
+
+    def __init__(self, port, latency):
+        self.port = port
+        self.latency = latency
+        self.ws = WSConnection(ConnectionType.CLIENT)
+        self.waiters = {}
+        self.message_id = itertools.count(1)
+        self.calls = 0
+        self.sends = 0
+        self.unexpected = 0
+        self.events = 0
+
+    async def connect(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    '127.0.0.1', self.port)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+        self.accepted = asyncio.get_running_loop().create_future()
+        self.writer.write(self.ws.send(Request(
+            host=f'127.0.0.1:{self.port}', target='/ws/',
+            extra_headers=[(b'X-Self-ID', str(SELF_ID).encode()),
+                           (b'X-Client-Role', b'Universal')])))
+        self.pump = asyncio.ensure_future(self.receive())
+        await self.accepted
+
+    async def receive(self):
+        text = []
+        while True:
+            data = await self.reader.read(65536)
+            self.ws.receive_data(data or None)
+            for event in self.ws.events():
+                if isinstance(event, AcceptConnection):
+                    self.accepted.set_result(True)
+                elif isinstance(event, RejectConnection):
+                    self.accepted.set_exception(ConnectionError('rejected'))
+                elif isinstance(event, Ping):
+                    self.writer.write(self.ws.send(event.response()))
+                elif isinstance(event, TextMessage):
+                    text.append(event.data)
+                    if event.message_finished:
+                        self.called(json.loads(''.join(text)))
+                        text = []
+                elif isinstance(event, CloseConnection):
+                    return
+            if not data:
+                return
+
+    def called(self, payload):
+        self.calls += 1
+        params = payload.get('params', {})
+        action = payload.get('action')
+        if action in ('send_msg', 'send_group_msg', 'send_private_msg'):
+            self.sends += 1
+            if params.get('group_id'):
+                target = ('group', params['group_id'])
+            else:
+                target = ('private', params.get('user_id'))
+            waiter = self.waiters.pop(target, None)
+            if waiter is None:
+                self.unexpected += 1
+            data = {'message_id': next(self.message_id)}
+        else:
+            waiter = None
+            data = {}
+        asyncio.get_running_loop().call_later(
+            random.random() * self.latency, self.answer, waiter, time.perf_counter(),
+            {'status': 'ok', 'retcode': 0, 'data': data, 'echo': payload.get('echo')})
+
+    def answer(self, waiter, received, payload):
+        self.send(payload)
+        # the command counts as answered when the message reached us, but
+        # like a real player the script only goes on once it was delivered
+        if waiter is not None and not waiter.done():
+            waiter.set_result(received)
+
+    def send(self, payload):
+        self.writer.write(self.ws.send(TextMessage(data=json.dumps(payload))))
+
+    async def command(self, group_id, user_id, text, expect):
+        """Post one message and return the seconds until the bot answers expect."""
+        waiter = self.waiters[expect] = asyncio.get_running_loop().create_future()
+        payload = {
+            'post_type': 'message', 'time': int(time.time()), 'self_id': SELF_ID,
+            'message_id': next(self.message_id), 'user_id': user_id,
+            'message': text, 'raw_message': text, 'font': 0,
+        }
+        if group_id:
+            payload.update(message_type='group', sub_type='normal',
+                           group_id=group_id, anonymous=None,
+                           sender={'user_id': user_id, 'role': 'member'})
+        else:
+            payload.update(message_type='private', sub_type='friend',
+                           sender={'user_id': user_id})
+        begin = time.perf_counter()
+        self.events += 1
+        self.send(payload)
+        return await waiter - begin
+
+
+def script(group_id, players):
+    """One game as (group_id or 0, user, text, who should get the answer, label)."""
+    judge = players[0]
+    group = ('group', group_id)
+    steps = [(group_id, judge, f'#set {RULE[0]} 0', group, 'set')]
+    for seat in range(1, len(players)):
+        steps.append((group_id, players[seat], f'#sit {seat}', group, 'sit'))
+    steps.append((group_id, judge, '#start', ('private', judge), 'start'))
+    steps.append((group_id, judge, '#vote start', group, 'vote'))
+    for seat in range(1, len(players)):
+        target = random.randrange(len(players))
+        steps.append((0, players[seat], f'#vote {target}',
+                      ('private', players[seat]), 'ballot'))
+    steps.append((group_id, judge, '#vote end', group, 'vote'))
+    steps.append((group_id, judge, f'#kill {random.randrange(1, len(players))}',
+                  group, 'kill'))
+    steps.append((group_id, random.choice(players), '#status', group, 'status'))
+    steps.append((group_id, judge, '#stop 好人', group, 'stop'))
+    return steps
+
+
+async def play(cq, group_id, games, timeout, think, latency, failures):
+    players = [group_id * 100 + seat for seat in range(len(RULE[1]) + 1)]
+    for _ in range(games):
+        for group, user, text, expect, label in script(group_id, players):
+            try:
+                took = await asyncio.wait_for(cq.command(group, user, text, expect), timeout)
+                latency.setdefault(label, []).append(took)
+                await asyncio.sleep(random.random() * think)
+            except asyncio.TimeoutError:
+                cq.waiters.pop(expect, None)
+                failures.append((group_id, text))
+
+
+def seed(workdir, port, args):
+    seed_rules(path.join(workdir, 'werewolf.db'))
+    rate = 20 if args.real_rates else 10**6
+    with open(path.join(workdir, 'config.py'), 'w') as f:
+        f.write(CONFIG.format(
+            admin=ADMIN, port=port, rate=rate,
+            group_rate=2 if args.real_rates else 10**6,
+            group_burst=5 if args.real_rates else 10**6))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def report(args, latency, failures, cq, elapsed, lag):
+    print(f"{args.groups} groups x {args.games} games: {cq.events} events, "
+          f"{cq.sends} messages sent in {elapsed:.2f}s")
+    print(f"  {cq.events / elapsed:.1f} events/s, {cq.sends / elapsed:.1f} messages/s, "
+          f"{cq.calls - cq.sends} other API calls, {cq.unexpected} unsolicited messages")
+    print(f"  {'command':<8}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+    every = []
+    for label in sorted(latency):
+        values = latency[label]
+        every += values
+        print(f"  {label:<8}{len(values):>7}" + "".join(
+            f"{percentile(values, p) * 1000:>9.1f}" for p in (50, 90, 99, 100)))
+    print(f"  {'all':<8}{len(every):>7}" + "".join(
+        f"{percentile(every, p) * 1000:>9.1f}" for p in (50, 90, 99, 100)))
+    if lag:
+        print(f"  loop lag: mean {sum(lag) / len(lag) * 1000:.2f}ms, "
+              f"p99 {percentile(lag, 99) * 1000:.2f}ms, max {max(lag) * 1000:.2f}ms "
+              f"over {len(lag)} samples")
+    if failures:
+        print(f"  {len(failures)} commands got no answer within {args.timeout}s, e.g. {failures[:3]}")
+
+
+async def drive(args, port):
+    cq = FakeCQHttp(port, args.latency)
+    await cq.connect()
+    latency = {}
+    failures = []
+    groups = [100000 + i for i in range(args.groups)]
+    begin = time.perf_counter()
+    await asyncio.gather(*[play(cq, group_id, args.games, args.timeout,
+                                args.think, latency, failures) for group_id in groups])
+    elapsed = time.perf_counter() - begin
+    return cq, latency, failures, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--games', type=int, default=2,
+                        help='games played one after another in every group')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='max seconds the stand-in takes to answer an API call')
+    parser.add_argument('--think', type=float, default=0.1,
+                        help='max seconds a player waits after an answer before the next command')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--real-rates', action='store_true',
+                        help='keep the default send rate limits instead of lifting them')
+    parser.add_argument('--lag-interval', type=float, default=0.01)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='run bot.py as a supervisor with this many workers '
+                        '(loop lag is only measured for a single process)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_bot(args.serve, args.lag_interval)
+        return
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='werewolf-load-')
+    port = free_port()
+    seed(workdir, port, args)
+    log = open(path.join(workdir, 'bot.log'), 'w')
+    if args.shards > 1:
+        # the supervisor and its workers find config.py through PYTHONPATH
+        command = [sys.executable, path.join(ROOT, 'bot.py'), '--shards', str(args.shards)]
+    else:
+        command = [sys.executable, path.abspath(__file__), '--serve', str(port),
+                   '--lag-interval', str(args.lag_interval)]
+    child = subprocess.Popen(
+        command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join([workdir, ROOT])))
+    try:
+        cq, latency, failures, elapsed = asyncio.run(drive(args, port))
+    finally:
+        child.send_signal(signal.SIGINT)
+        try:
+            child.wait(10)
+        except subprocess.TimeoutExpired:
+            child.kill()
+    lag_file = path.join(workdir, 'lag.json')
+    lag = json.load(open(lag_file)) if path.exists(lag_file) else []
+    report(args, latency, failures, cq, elapsed, lag)
+    if args.keep:
+        print(f"  working directory: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
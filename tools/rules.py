@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Imports and exports rule sets and their aliases straight to werewolf.db,
+in the format of #importrules / #exportrules. An import is validated as a
+whole and written in one transaction, or not at all. Restart the bot, or
+touch a rule with #addrole / #setalias, for a running bot to see it.
+
+    python tools/rules.py export --format toml > rules.toml
+    python tools/rules.py import rules.toml --db werewolf.db
+    python tools/rules.py sample 5000 > many.json
+"""
+__author__ = 'QAQAutoMaton'
+
+from os import path
+import argparse
+import sys
+import time
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from wbot.werewolf import ruleset
+from wbot.werewolf.rules import RuleCache
+from wbot.werewolf.storage import Repository
+
+GOOD = ('预言家', '女巫', '猎人', '守卫', '白痴', '平民')
+WOLVES = ('狼人', '白狼王', '狼美人')
+
+
+def sample(n):
+    """n distinct made-up boards, for timing an import."""
+    body = []
+    for i in range(n):
+        good = [GOOD[j] for j in range(len(GOOD)) if i >> j & 1] + ['平民'] * (i % 4)
+        wolves = [WOLVES[j] for j in range(len(WOLVES)) if i >> (j + 6) & 1] + ['狼人'] * (1 + i % 3)
+        body.append((f"样例{i}", [f"s{i}"], [(one, 1) for one in good] + [(one, 2) for one in wolves]))
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('action', choices=('import', 'export', 'sample'))
+    parser.add_argument('arg', nargs='?', help='file to import (- for stdin), or how many boards to sample')
+    parser.add_argument('--db', default=path.join(ROOT, 'werewolf.db'))
+    parser.add_argument('--format', choices=('json', 'toml'), default='json')
+    args = parser.parse_args()
+    write = ruleset.write_toml if args.format == 'toml' else ruleset.write_json
+    if args.action == 'sample':
+        sys.stdout.write(write(sample(int(args.arg or 1000))))
+        return
+    repo = Repository(args.db)
+    repo.prepare()
+    if args.action == 'export':
+        sys.stdout.write(write(repo.run_sync(Repository._export_rules)))
+        return
+    if args.arg is None:
+        parser.error("import needs a file")
+    text = sys.stdin.read() if args.arg == '-' else open(args.arg, encoding='utf-8').read()
+    begin = time.perf_counter()
+    data, error = ruleset.read(text)
+    if error is not None:
+        sys.exit(error)
+    rules = RuleCache()
+    rules.load(*repo.run_sync(Repository._load_rules))
+    entries, errors = ruleset.validate(data, lambda name: rules.find(name) is not None)
+    if errors:
+        sys.exit("没有导入任何规则：\n" + ruleset.explain(errors))
+    parsed = time.perf_counter()
+    rules.load(*repo.run_sync(Repository._import_rules, entries))
+    repo.close()
+    print(f"imported {len(entries)} rules ({sum(len(r) for _, _, r in entries)} identities) "
+          f"in {time.perf_counter() - begin:.3f}s, {time.perf_counter() - parsed:.3f}s of it "
+          f"in the transaction; {len(rules.identity)} rules in {args.db}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fires thousands of concurrent random werewolf commands through nonebot's own
+event pipeline, with sends that sleep a random moment so handlers interleave,
+then checks every table and in_game for consistency.
+
+    python tools/stress.py --groups 20 --users 200 --events 20000
+"""
+__author__ = 'QAQAutoMaton'
+
+from os import path
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import tempfile
+import time
+import types
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import nonebot
+from nonebot import default_config
+from common import ADMIN, RULE, pick_user, seed_rules
+from fuzz import check
+
+MIX = (('#set {rule} {pos}', 2), ('#sit {pos}', 12), ('#stand', 1),
+       ('#status', 1), ('#start', 3), ('#resend', 1), ('#remake', 1),
+       ('#kill {pos}', 2), ('#vote start', 2), ('#vote end', 2),
+       ('#vote pk', 1), ('#stop 好人', 1), ('#stop 狼人', 1))
+COMMANDS = [one for one, weight in MIX]
+WEIGHTS = [weight for one, weight in MIX]
+
+
+def make_config(workdir):
+    config = types.ModuleType('config')
+    for k in dir(default_config):
+        if k.isupper():
+            setattr(config, k, getattr(default_config, k))
+    config.COMMAND_START = {'#'}
+    config.WEREWOLF_ADMINS = [ADMIN]
+    config.WEREWOLF_DB_PATH = path.join(workdir, 'werewolf.db')
+    config.WEREWOLF_STATE_PATH = path.join(workdir, 'werewolf.state')
+    config.WEREWOLF_EVENT_LOG_PATH = path.join(workdir, 'werewolf.events')
+    config.WEREWOLF_SEND_RATE = 10**6
+    config.WEREWOLF_GROUP_SEND_RATE = 10**6
+    config.WEREWOLF_GROUP_SEND_BURST = 10**6
+    config.WEREWOLF_DEAL_RATE = 10**6
+    return config
+
+
+message_id = itertools.count(1)
+
+
+def group_event(group_id, user_id, text):
+    return {
+        'post_type': 'message', 'message_type': 'group', 'sub_type': 'normal',
+        'time': int(time.time()), 'self_id': 10000, 'message_id': next(message_id),
+        'group_id': group_id, 'user_id': user_id, 'anonymous': None,
+        'message': text, 'raw_message': text, 'font': 0,
+        'sender': {'user_id': user_id, 'nickname': str(user_id), 'role': 'member'},
+    }
+
+
+def private_event(user_id, text):
+    return {
+        'post_type': 'message', 'message_type': 'private', 'sub_type': 'friend',
+        'time': int(time.time()), 'self_id': 10000, 'message_id': next(message_id),
+        'user_id': user_id, 'message': text, 'raw_message': text, 'font': 0,
+        'sender': {'user_id': user_id, 'nickname': str(user_id)},
+    }
+
+
+def random_event(groups, users):
+    i = random.randrange(len(groups))
+    group_id = groups[i]
+    user_id = pick_user(users, len(groups), i)
+    pos = random.randint(0, len(RULE[1]))
+    kind = random.random()
+    if kind < 0.08:
+        return private_event(user_id, f"#vote {pos}")
+    if kind < 0.09:
+        return group_event(group_id, ADMIN, random.choice(
+            [f"#kick {pos}", "#kickall", "#kickall --force", "#stop --force"]))
+    text = random.choices(COMMANDS, WEIGHTS)[0].format(rule=RULE[0], pos=pos)
+    return group_event(group_id, user_id, text)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='werewolf-stress-')
+    config = make_config(workdir)
+    nonebot.init(config)
+    seed_rules(config.WEREWOLF_DB_PATH)
+    bot = nonebot.get_bot()
+    sent = [0]
+
+    async def fake_send(**kwargs):
+        await asyncio.sleep(random.random() * args.latency)
+        sent[0] += 1
+        return {'message_id': sent[0]}
+
+    bot.send_msg = bot.send_group_msg = bot.send_private_msg = fake_send
+    nonebot.load_plugin('wbot.plugins.werewolf')
+    W = sys.modules['wbot.plugins.werewolf']
+
+    groups = [100000 + i for i in range(args.groups)]
+    users = [200000 + i for i in range(args.users)]
+    started = set()
+
+    async def watch():
+        while True:
+            started.update(k for k, g in W.game.items() if g.running)
+            await asyncio.sleep(0.01)
+    watcher = asyncio.ensure_future(watch())
+    begin = time.perf_counter()
+    for i in range(0, args.events, args.burst):
+        for _ in range(min(args.burst, args.events - i)):
+            await bot._handle_event(random_event(groups, users))
+        await asyncio.sleep(0)
+    # wait for every handler task started above
+    while len(asyncio.all_tasks()) > 2:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - begin
+    watcher.cancel()
+    await W.journal.flush()
+
+    errors = check(W.game, W.in_game)
+    running = sum(1 for g in W.game.values() if g.running)
+    print(f"{args.events} events over {args.groups} groups in {elapsed:.2f}s "
+          f"({args.events / elapsed:.0f}/s), {sent[0]} sends, "
+          f"{len(started)} tables started a game, {running} still running, {len(W.in_game)} seated")
+    for one in errors[:20]:
+        print("  " + one)
+    print("consistent" if not errors else f"{len(errors)} inconsistencies")
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--burst', type=int, default=500,
+                        help='events injected before yielding to the loop')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='max seconds a fake send sleeps')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
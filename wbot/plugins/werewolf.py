@@ -3,688 +3,934 @@
 __author__ = 'QAQAutoMaton'
 
 
+from concurrent.futures import ProcessPoolExecutor
 from math import log
+import asyncio
+import functools
+import multiprocessing
+import weakref
+import sys
+import time
 from nonebot import on_command, CommandSession, message
 from nonebot import on_request, RequestSession
 from nonebot import permission as perm
+from wbot.werewolf import auto, balance, metrics, ruleset
+from wbot.werewolf.core import Core, Event, LEVELED
+from wbot.werewolf.dispatch import Dispatcher
+from wbot.werewolf.eventlog import EventLog
+from wbot.werewolf.game import Game, composition, cq_at
+from wbot.werewolf.journal import Journal
+from wbot.werewolf.outbox import Outbox, SEND_FAILURES, SEND_SECONDS
+from wbot.werewolf.permission import PermissionCache
+from wbot.werewolf.rules import RuleCache
+from wbot.werewolf.shard import IndexMirror, InGame, SeatIndex
+from wbot.werewolf.storage import CAMPS, Repository
+from wbot.werewolf.timer import TimerWheel
 import random
 import re
 import sqlite3
 import nonebot
 
-db = sqlite3.connect('werewolf.db')
-c = db.cursor()
+try:
+    import resource
+except ImportError:
+    # Unix only; elsewhere #memory leaves out the peak
+    resource = None
 
+config = nonebot.get_bot().config
+# (shard, shards) when bot.py runs this process as one of several workers
+shard = getattr(config, 'WEREWOLF_SHARD', None)
+index = IndexMirror(SeatIndex(getattr(config, 'WEREWOLF_SEAT_INDEX_PATH', 'werewolf.seats')),
+                    getattr(config, 'WEREWOLF_SEAT_POLL_INTERVAL', 0.1)) if shard else None
+repo = Repository(getattr(config, 'WEREWOLF_DB_PATH', 'werewolf.db'))
+opening = time.perf_counter()
 
-def cq_at(uid):
-    return f"[CQ:at,qq={uid}]"
+
+def opened(done):
+    if done.exception() is None:
+        nonebot.logger.info(f"werewolf: database ready in {time.perf_counter() - opening:.3f}s")
+    else:
+        nonebot.logger.error(f"werewolf: cannot open the database: {done.exception()!r}")
+
+
+# migrated on the db thread while the bot starts, queries queue up behind
+repo.open().add_done_callback(opened)
+rules = RuleCache()
+rules_loading = repo.submit(Repository._load_rules) \
+    if getattr(config, 'WEREWOLF_PRELOAD_RULES', True) else None
+rules_loaded = False
+rules_version = 0
+permissions_version = 0
+permissions = PermissionCache(repo,
+                              getattr(config, 'WEREWOLF_PERMISSION_CACHE_SIZE', 4096),
+                              getattr(config, 'WEREWOLF_PERMISSION_TTL', 600))
 
 
 def split(text):
     return re.split(",|，", text)
 
 
-class Game:
-    def __init__(self):
-        self.player_num = 0
-        self.roleid = 0
-        self.role = []
-        self.player = []
-        self.identity = []
-        self.alive = []
-        self.running = False
-        self.online = False
-        self.onVote = False
-        self.vote = []
-
-    def empty(self, uid=-1):
-        for one in self.player:
-            if one != 0 and one != uid:
-                return False
-        return True
-
-    def init(self, role, online=True):
-        self.role = c.execute(
-            "select name,type from roles_identity where id=?", (role,)).fetchall()
-        self.online = online
-        self.roleid = role
-        self.player_num = len(self.role)
-        self.identity = []
-        self.alive = [True]*(self.player_num+1)
-        self.running = False
-        self.player = [0]*(self.player_num+1)
-        self.onVote = False
-
-    def sit(self, uid, pos):
-        if pos > self.player_num or pos < 0:
-            return "位置在[0..人数]之间"
-        if uid in self.player:
-            return "你已经加入了"
-        if self.player[pos] != 0:
-            return "这个位置有人了"
-        self.player[pos] = uid
-        return ""
-
-    def stand(self, uid):
-        if uid not in self.player:
-            return "你没有加入"
-        if self.running:
-            return "游戏已经开始"
-        self.player[self.player.index(uid)] = 0
-        return ""
-
-    def kick(self, pos):
-        if pos > self.player_num or pos < 0:
-            return (False, "位置在[0..人数]之间")
-        if self.running:
-            return (False, "游戏已经开始")
-        if self.player[pos] == 0:
-            return (False, "这个位置没有人")
-        uid = self.player[pos]
-        self.player[pos] = 0
-        return (True, uid)
-
-    def preview(self):
-        s = ""
-        if self.running:
-            s = "游戏已开始，"
-        s += "配置为："
-        las = ""
-        last_cnt = 0
-        for i in range(self.player_num):
-            if i == 0 or self.role[i][0] != las:
-                if last_cnt > 1:
-                    s += f"*{last_cnt}"
-                if last_cnt > 0:
-                    s += "，"
-                last_cnt = 1
-                las = self.role[i][0]
-                s += las
-            else:
-                last_cnt += 1
-        if last_cnt > 1:
-            s += f"*{last_cnt}"
-        s += "\n"
-        s += "人员为：\n"
-        for i in range(self.player_num+1):
-            s += f"{i}" + ("(法官)" if i == 0 else "") + ": "
-            if self.player[i] == 0:
-                s += "空"
-            else:
-                s += cq_at(self.player[i])
-            if self.running and not self.alive[i]:
-                s += "「已死亡」"
-            s += "\n"
-        s += "为获取身份，请添加bot为好友。"
-        return s
-
-    def generate(self):
-        self.identity = list(range(self.player_num))
-        random.shuffle(self.identity)
-        self.identity = self.identity
-        self.running = True
+game = {}
+in_game = InGame(index,
+                 (lambda group_id: group_id % shard[1] == shard[0]) if shard else None)
+journal = Journal(getattr(config, 'WEREWOLF_STATE_PATH', 'werewolf.state') +
+                  (f".{shard[0]}" if shard else ""),
+                  lambda group_id: game[group_id].dump() if group_id in game else None,
+                  lambda: list(game),
+                  getattr(config, 'WEREWOLF_STATE_FLUSH_INTERVAL', 0.5))
+restoring = None
+nonebot.get_bot().server_app.after_serving(journal.flush)
+events_path = getattr(config, 'WEREWOLF_EVENT_LOG_PATH', 'werewolf.events')
+events = EventLog(events_path + (f".{shard[0]}" if shard else ""),
+                  getattr(config, 'WEREWOLF_EVENT_LOG_INTERVAL', 0.5))
+nonebot.get_bot().server_app.after_serving(events.flush)
+
+
+async def restore_tables():
+    # commands wait for this, so it always completes; what fails is logged and left out
+    begin = time.perf_counter()
+    try:
+        tables = await journal.restore(Game.load)
+    except Exception as e:
+        nonebot.logger.error(f"werewolf: cannot read the journal, no tables restored: {e!r}")
+        return
+    game.update(tables)
+    in_game.restore((uid, group_id) for group_id, g in tables.items() for uid in g.seat)
+    for group_id in tables:
+        try:
+            arm(group_id)
+        except Exception as e:
+            nonebot.logger.error(f"werewolf: cannot rearm the timers of group {group_id}: {e!r}")
+    nonebot.logger.info(f"werewolf: restored {len(tables)} tables in "
+                        f"{time.perf_counter() - begin:.3f}s")
+
+
+def restored():
+    """Replays the journal in the background on first call; commands await it before touching tables."""
+    global restoring
+    if restoring is None:
+        restoring = asyncio.ensure_future(restore_tables())
+    return restoring
+
+
+@nonebot.on_startup
+async def start_restore():
+    restored()
+
+
+async def sweep_idle():
+    idle = getattr(config, 'WEREWOLF_IDLE_TTL', 2*3600)
+    running_idle = getattr(config, 'WEREWOLF_RUNNING_IDLE_TTL', 6*3600)
+    while True:
+        await asyncio.sleep(getattr(config, 'WEREWOLF_IDLE_SWEEP_INTERVAL', 300))
+        now = time.time()
+        for group_id in list(game):
+            g = game.get(group_id)
+            if g is None or now - g.active < (running_idle if g.running else idle):
+                continue
+            lock = table_lock(group_id)
+            if lock.locked():
+                continue
+            async with lock:
+                if game.get(group_id) is not g:
+                    continue
+                await apply(None, core.remove(group_id), g.account)
+            if g.running or not g.empty():
+                try:
+                    await outbox.group(g.account, group_id, "本桌长时间无人操作，已自动清除")
+                except Exception:
+                    pass
+
+
+sweeper = None
+
+
+@nonebot.on_startup
+async def start_sweeper():
+    global sweeper
+    sweeper = asyncio.ensure_future(sweep_idle())
+    if index is not None:
+        index.start()
+
+
+async def permission(uid):
+    global permissions_version
+    if uid in getattr(config, 'WEREWOLF_ADMINS', []):
+        return 1 << 30
+    if index is not None and index.version('permissions') != permissions_version:
+        permissions_version = index.version('permissions')
+        permissions.invalidate()
+    return await permissions.get(uid)
+
+
+async def fresh_rules():
+    """
+    Loads the rule cache on first use (unless it was preloaded) and again
+    whenever another shard has changed the rules since.
+    """
+    global rules_loading, rules_loaded, rules_version
+    if index is not None and index.version('rules') != rules_version:
+        rules_version = index.version('rules')
+        rules_loading = None
+        rules_loaded = False
+    if rules_loaded:
+        return
+    if rules_loading is None:
+        rules_loading = repo.submit(Repository._load_rules)
+    loading = rules_loading
+    try:
+        result = await asyncio.wrap_future(loading)
+    except Exception:
+        # the next command tries again
+        if loading is rules_loading:
+            rules_loading = None
+        raise
+    # someone else may have loaded, and since changed, the cache meanwhile
+    if not rules_loaded and loading is rules_loading:
+        rules.load(*result)
+        rules_loaded = True
+
+
+def rules_changed():
+    if index is not None:
+        index.bump('rules')
 
 
-game = {}
-in_game = {}
+def permissions_changed():
+    if index is not None:
+        index.bump('permissions')
 
 
-def permission(uid):
-    l = c.execute("select permission from permission where qq=?",
-                  (uid,)).fetchall()
-    if len(l) == 0:
-        return 0
-    return l[0][0]
+async def deliver(target, message):
+    bot = nonebot.get_bot()
+    self_id, kind, target_id = target
+    if kind == 'group':
+        await bot.send_group_msg(self_id=self_id, group_id=target_id, message=message)
+    else:
+        await bot.send_private_msg(self_id=self_id, user_id=target_id, message=message)
+
+
+outbox = Outbox(deliver,
+                getattr(config, 'WEREWOLF_SEND_RATE', 20),
+                getattr(config, 'WEREWOLF_GROUP_SEND_RATE', 2),
+                getattr(config, 'WEREWOLF_GROUP_SEND_BURST', 5),
+                getattr(config, 'WEREWOLF_MAX_PENDING_SENDS', 1000))
+
+
+async def send(session: CommandSession, message):
+    if session.event.group_id:
+        await outbox.group(session.event.self_id, session.event.group_id, message)
+    elif session.event.message_type == 'private':
+        await outbox.private(session.event.self_id, session.event.user_id, message)
+    else:
+        with SEND_SECONDS.labels('session').time():
+            try:
+                await session.send(message)
+            except Exception:
+                SEND_FAILURES.labels('session').inc()
+                raise
 
 
 async def send_at(session: CommandSession, message):
-    await session.send(cq_at(session.event.user_id) + ' ' + message)
+    await send(session, cq_at(session.event.user_id) + ' ' + message)
 
 
-async def send_private(uid, message):
-    bot = nonebot.get_bot()
-    await bot.send_private_msg(user_id=uid, message=message)
+async def send_private(self_id, uid, message):
+    await outbox.private(self_id, uid, message)
+
+
+dispatcher = Dispatcher(send_private,
+                        getattr(config, 'WEREWOLF_DEAL_CONCURRENCY', 16),
+                        getattr(config, 'WEREWOLF_DEAL_RATE', 20),
+                        getattr(config, 'WEREWOLF_DEAL_RETRIES', 2))
 
 
 async def reply(session: CommandSession, message):
     if not session.event.group_id:
-        await send_private(session.event.user_id, message)
+        await send_private(session.event.self_id, session.event.user_id, message)
     else:
         await send_at(session, message)
 
 
-async def try_sit(session: CommandSession, pos):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    result = game[group_id].sit(user_id, pos)
-    if result == "":
-        in_game[user_id] = group_id
-        return True
-    else:
-        await send_at(session, result)
-        return False
-
-
-async def send_identity(session: CommandSession):
-    group_id = session.event.group_id
-    g = game[group_id]
-    wolf = []
-    if g.online:
-        for i in range(g.player_num):
-            if g.role[g.identity[i]][1] == 2:
-                wolf.append(i+1)
-    for i in range(g.player_num):
-        s = f"您是{i+1}号，您的身份是{g.role[g.identity[i]][0]}。"
-        if g.online and g.role[g.identity[i]][1] == 2:
-            s += f"您的狼队友为{wolf}。"
-        await send_private(g.player[i+1], s)
-    s = "您是法官，\n"
-    for i in range(g.player_num):
-        s += f"{i+1}号：{g.role[g.identity[i]][0]}\n"
-    s = s[:-1]
-    await send_private(g.player[0], s)
+auto.TIMINGS.update(getattr(config, 'WEREWOLF_AUTO_TIMINGS', {}))
+auto.IDLE_PHASES = getattr(config, 'WEREWOLF_AUTO_IDLE_PHASES', auto.IDLE_PHASES)
+# one wheel drives the deadlines of every auto-moderated table
+wheel = TimerWheel(getattr(config, 'WEREWOLF_TIMER_TICK', 1.0))
+timers = {}
 
 
-@on_command('set', aliases=('设置', 'sz'), only_to_me=False, permission=perm.GROUP)
-async def setting(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if in_game.get(user_id, False) and in_game[user_id] != group_id:
-        await send_at(session, "你已经在某个群加入了,请先退出")
-        return False
-    if group_id in game:
-        if not game[group_id].empty(user_id):
-            await send_at(session, '当前桌还有人')
-            return
-        else:
-            in_game[user_id] = False
-    else:
-        game[group_id] = Game()
+def arm(group_id):
+    disarm(group_id)
+    g = game.get(group_id)
+    if g is not None and g.running and g.auto is not None and g.auto.phase is not None:
+        timers[group_id] = wheel.schedule(max(0, g.auto.deadline - time.time()),
+                                          expire, group_id, g.auto.step)
 
-    if 'role' not in session.state:
-        await send_at(session, "用法：#set 规则名 位置")
-        return
-    else:
-        role = session.state['role']
-        try:
-            pos = int(session.state['pos'])
-        except ValueError:
-            await send_at(session, "位置是一个[0..人数]之间的整数")
-            return
-        role_id = c.execute(
-            "select id from roles_alias where name=?", (role,)).fetchall()
-        if len(role_id) == 0:
-            await send_at(session, "找不到这个规则")
-            return
-        role_id = role_id[0][0]
-        game[group_id].init(role_id)
-        if await try_sit(session, pos):
-            await send_at(session, "创建成功，"+game[group_id].preview())
 
+def disarm(group_id):
+    timer = timers.pop(group_id, None)
+    if timer is not None:
+        wheel.cancel(timer)
 
-@setting.args_parser
-async def setting_parser(session: CommandSession):
-    args = session.current_arg_text.strip().split()
-    if len(args) == 2:
-        session.state['role'] = args[0]
-        session.state['pos'] = args[1]
 
+def expire(group_id, step):
+    timers.pop(group_id, None)
+    asyncio.ensure_future(expired(group_id, step))
 
-@on_command('sit', aliases=('jr', '加入', '坐下'), only_to_me=False, permission=perm.GROUP)
-async def sit(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群没有设定板子，请使用set命令设置')
-        return
-    if in_game.get(user_id, False) and in_game[user_id] != group_id:
-        await send_at(session, "你已经在某个群加入了,请先退出")
-        return False
-    if 'pos' not in session.state:
-        await send_at(session, "用法：#sit 位置\n如： #sit 1")
-        return
+
+async def expired(group_id, step):
     try:
-        pos = int(session.state['pos'])
-    except ValueError:
-        await send_at(session, "位置为一个[0..人数]之间的整数")
-        return
+        async with table_lock(group_id):
+            g = game.get(group_id)
+            await apply(None, core.expire(group_id, step), g and g.account)
+    except Exception:
+        nonebot.logger.exception(f"werewolf: deadline of {group_id} failed")
+
+
+core = Core(game, in_game, rules)
+
+
+async def apply(session, effects, account=None):
+    """
+    Carries out what the core asked for, in order, sending from the account
+    session came in on (account when there is no session). Consecutive
+    messages are sent concurrently; a failed send does not stop the rest,
+    its error is raised once everything else is done.
+    """
+    if session is not None:
+        account = session.event.self_id
+    sends = []
+    errors = []
+
+    async def flush():
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        sends.clear()
+        errors.extend(one for one in results if isinstance(one, Exception))
+
+    for effect in effects:
+        kind = effect[0]
+        if kind == 'reply':
+            sends.append(reply(session, effect[1]))
+        elif kind == 'group':
+            sends.append(outbox.group(account, effect[1], effect[2]))
+        elif kind == 'private':
+            sends.append(send_private(account, effect[1], effect[2]))
+        elif kind == 'mark':
+            journal.mark(effect[1])
+        elif kind == 'log':
+            events.append(effect[1], effect[2])
+        elif kind == 'arm':
+            arm(effect[1])
+        elif kind == 'disarm':
+            disarm(effect[1])
+        elif kind == 'deal':
+            await flush()
+            failed = await dispatcher.send_all(account, effect[2])
+            await apply(session, core.undelivered(effect[1], failed), account)
+        elif kind == 'record':
+            await flush()
+            events.close(effect[1], await repo.record_game(*effect[1:]), CAMPS.get(effect[6], ''))
+    await flush()
+    if errors:
+        raise errors[0]
+
+
+async def play(session: CommandSession, ctx, command):
+    """Runs a table command through the core."""
+    level = await ctx.level() if command in LEVELED else 0
+    effects = core.handle(Event(command, ctx.group_id, ctx.user_id,
+                                session.current_arg_text.strip(), level))
+    if ctx.group_id in game:
+        # timers and the sweeper speak for the table through the account it is played on
+        game[ctx.group_id].account = session.event.self_id
+    await apply(session, effects)
+
+
+metrics.Gauge('werewolf_auto_timers', 'Pending auto-moderator deadlines',
+              lambda: wheel.count)
+metrics.Gauge('werewolf_tables', 'Tables in memory', lambda: len(game))
+metrics.Gauge('werewolf_running_tables', 'Tables with a game in progress',
+              lambda: sum(1 for g in game.values() if g.running))
+metrics.Gauge('werewolf_seated_players', 'Users sitting at a table, judges included',
+              lambda: len(in_game))
+metrics.Gauge('werewolf_outbox_pending', 'Messages waiting to be sent',
+              lambda: outbox.pending)
+
+
+async def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+if getattr(config, 'WEREWOLF_METRICS_PATH', '/metrics'):
+    nonebot.get_bot().server_app.add_url_rule(
+        getattr(config, 'WEREWOLF_METRICS_PATH', '/metrics'),
+        'werewolf_metrics', metrics_endpoint)
+
+
+class Context:
+    """Who sent a werewolf command and where, with their permission level looked up on demand."""
+
+    __slots__ = ('group_id', 'user_id', '_level')
+
+    def __init__(self, session: CommandSession):
+        self.group_id = session.event.group_id
+        self.user_id = session.event.user_id
+        self._level = None
+
+    async def level(self):
+        if self._level is None:
+            self._level = await permission(self.user_id)
+        return self._level
+
+
+locks = weakref.WeakValueDictionary()
+
+
+def table_key(session: CommandSession):
+    key = session.event.group_id or in_game.get(session.event.user_id)
+    if not key:
+        return ('user', session.event.user_id)
+    return key
+
+
+def table_lock(key):
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
+
+commands = metrics.Counter('werewolf_commands_total',
+                           'Werewolf commands handled', ['command'])
+command_errors = metrics.Counter('werewolf_command_errors_total',
+                                 'Werewolf commands that raised', ['command'])
+command_seconds = metrics.Histogram('werewolf_command_seconds',
+                                    'Time to handle a werewolf command, waiting for the table included',
+                                    ['command'])
+
+
+def instrumented(func):
+    """Counts calls, failures and latency of a command handler, under its function's name."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(session: CommandSession):
+        begin = time.perf_counter()
+        try:
+            await func(session)
+        except Exception:
+            command_errors.labels(name).inc()
+            raise
+        finally:
+            commands.labels(name).inc()
+            command_seconds.labels(name).observe(time.perf_counter() - begin)
+    return wrapper
+
+
+def guard(group=True, level=0, denied="你没有权限"):
+    """
+    Shared checks for werewolf commands, run in this order: group chat only,
+    no anonymous users, permission level; table checks are the core's (see
+    core.command). The handler is called as func(session, ctx) while holding
+    the table's lock, so commands on one table never interleave.
+    """
+    def deco(func):
+        @instrumented
+        @functools.wraps(func)
+        async def wrapper(session: CommandSession):
+            await guarded(session, func)
+        return wrapper
+
+    async def guarded(session, func):
+        await restored()
+        if group and not session.event.group_id:
+            await send(session, '请在群聊中使用狼人杀功能')
+            return
+        if session.event.user_id == 80000000:
+            await send(session, '请解除匿名后再使用狼人杀功能')
+            return
+        while True:
+            key = table_key(session)
+            async with table_lock(key):
+                # a private message follows in_game, which may have moved while we waited
+                if key != table_key(session):
+                    continue
+                ctx = session.state['context'] = Context(session)
+                await checked(session, ctx, func)
+                return
 
-    if await try_sit(session, pos):
-        await send_at(session, "加入成功，" + game[group_id].preview())
+    async def checked(session, ctx, func):
+        if level and await ctx.level() < level:
+            await reply(session, denied)
+            return
+        await func(session, ctx)
+    return deco
 
 
-@sit.args_parser
-async def sit_parser(session: CommandSession):
-    args = session.current_arg_text.strip().split()
-    if len(args) == 1:
-        session.state['pos'] = args[0]
+@on_command('set', aliases=('设置', 'sz'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def setting(session: CommandSession, ctx: Context):
+    await fresh_rules()
+    await play(session, ctx, 'set')
+
+
+@on_command('sit', aliases=('jr', '加入', '坐下'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def sit(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'sit')
 
 
 @on_command('stand', aliases=('tc', '退出', '站起'), only_to_me=False, permission=perm.GROUP)
-async def stand(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    result = game[group_id].stand(user_id)
-    if result == "":
-        in_game[user_id] = False
-        await send_at(session, "退出成功，" + game[group_id].preview())
-    else:
-        await send_at(session, result)
+@guard()
+async def stand(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'stand')
 
 
 @on_command('status', aliases=('zt', '状态'), only_to_me=False, permission=perm.GROUP)
-async def status(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    await send_at(session, game[group_id].preview())
+@guard()
+async def status(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'status')
 
 
 @on_command('start', aliases=('ks', '开始'), only_to_me=False, permission=perm.GROUP)
-async def start(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    g = game[group_id]
-    if user_id not in g.player:
-        await send_at(session, "你还没有加入游戏")
-        return
-    if 0 in g.player:
-        await send_at(session, "人数不足，无法开始")
-        return
-    if g.running:
-        await send_at(session, "游戏已经开始")
-        return
-
-    g.generate()
-    await send_identity(session)
+@guard()
+async def start(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'start')
 
 
 @on_command('resend', aliases=('重发'), only_to_me=False, permission=perm.GROUP)
-async def resend(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    g = game[group_id]
-    if not g.running:
-        await send_at(session, "未开始")
-    elif user_id != g.player[0]:
-        await send_at(session, "只有法官可以要求重新发牌")
-    else:
-        await send_identity(session)
+@guard()
+async def resend(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'resend')
 
 
 @on_command('remake', aliases=('重生成身份'), only_to_me=False, permission=perm.GROUP)
-async def remake(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    g = game[group_id]
-    if not g.running:
-        await send_at(session, "未开始")
-    elif user_id != g.player[0]:
-        await send_at(session, "只有法官可以要求重新生成身份")
-    else:
-        g.generate()
-        await send_identity(session)
+@guard()
+async def remake(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'remake')
 
 
 @on_command('stop', aliases=('jieshu', 'js', '结束'), only_to_me=False, permission=perm.GROUP)
-async def stop(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    g = game[group_id]
-    if g.running:
-        if session.state['force']:
-            if permission(user_id) == 0:
-                await send_at(session, "你没有权限")
-                return
-        else:
-            if user_id != g.player[0]:
-                await send_at(session, "你不是法官，无权结束")
-                return
-        for i in game[group_id].player:
-            in_game[i] = False
-        s = "游戏已结束，身份为：\n"
-        for i in range(g.player_num):
-            s += "{}号({})：{}{}\n".format(i + 1, cq_at(
-                g.player[i + 1]), g.role[g.identity[i]][0], ("" if g.alive[i+1] else "「已死亡」"))
-        g.player = [0] * (g.player_num + 1)
-        g.running = False
-        g.alive = [True]*(g.player_num+1)
-        await send_at(session, s)
+@guard()
+async def stop(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'stop')
+
+
+@on_command('kick', aliases=('踢人'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def kick(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'kick')
+
+
+@on_command('kickall', aliases=('清场', 'qc'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def kickall(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'kickall')
+
+
+@on_command('kill', aliases=('杀'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def kill(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'kill')
+
+
+@on_command('addrole', aliases=('新建规则'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False, level=1, denied="您没有权限添加规则")
+async def addrole(session: CommandSession, ctx: Context):
+    if 'args' not in session.state:
+        await reply(session, "用法：addrole 规则名 好人阵营的身份列表 狼人阵营(夜里见面)的身份列表 狼人阵营(夜里不见面)的身份列表，其中列表用逗号而非空格隔开，如果没有用单一个逗号即可")
         return
-    else:
-        await send_at(session, "未开始")
+    args = session.state['args']
+    name = args[0]
+    await fresh_rules()
+    if rules.find(name) is not None:
+        await reply(session, "规则已存在")
+        return
+
+    rows, error = ruleset.parse_identities(ruleset.split_lists(args[1:4]))
+    if error is not None:
+        await reply(session, error)
+        return
+    message = f"规则 {name} 创建成功，包含{composition(tuple(rows), ',')}"
+    try:
+        _id = await repo.add_rule(name, rows)
+    except sqlite3.IntegrityError:
+        # another shard took the name since the cache was loaded
+        await reply(session, "规则已存在，请重试")
         return
+    rules.add(_id, name, rows)
+    rules_changed()
+    await reply(session, message)
 
 
-@stop.args_parser
-async def stop_parser(session: CommandSession):
+@addrole.args_parser
+async def addrole_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 1 and args[0] == "--force":
-        session.state['force'] = True
-    else:
-        session.state['force'] = False
+    if len(args) == 4:
+        session.state['args'] = args
 
 
-@on_command('kick', aliases=('踢人'), only_to_me=False, permission=perm.GROUP)
-async def kick(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
+@on_command('setalias', aliases=('设置规则别名'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False, level=1, denied="您没有权限设置规则别名")
+async def setalias(session: CommandSession, ctx: Context):
+    if 'name' not in session.state:
+        await reply(session, "用法：setalias 规则名 规则的别名 (用逗号分隔开)")
         return
-    if permission(user_id) < 1:
-        await send_at(session, "你没有权限踢人")
+    name = session.state['name']
+    aliases = split(session.state['aliases'])
+    aliases = [i for i in aliases if len(i)]
+    await fresh_rules()
+    _id = rules.find(name)
+    if _id is None:
+        await reply(session, "找不到规则")
         return
-    if 'pos' not in session.state:
-        await send_at(session, "用法：#kick 位置")
+    if rules.alias_conflict(_id, aliases):
+        await reply(session, "设置的别名不能和其它规则相同")
         return
-    g = game[group_id]
     try:
-        pos = int(session.state['pos'])
-    except ValueError:
-        await send_at(session, "位置为一个[0..人数]之间的整数")
+        al = await repo.replace_aliases(_id, name, aliases)
+    except sqlite3.IntegrityError:
+        await reply(session, "设置的别名不能和其它规则相同，请重试")
         return
-    if not (0 <= pos <= g.player_num):
-        await send_at(session, "位置为一个[0..人数]之间的整数")
-    elif g.player[pos] == 0:
-        await send_at(session, "此位置没有人")
-    else:
-        qq = g.player[pos]
-        result = g.stand(qq)
-        if result == "":
-            in_game[user_id] = False
-            await send_at(session, "踢出{}成功，".format(cq_at(qq)) + g.preview())
-        else:
-            await send_at(session, result)
+    rules.set_aliases(_id, al)
+    rules_changed()
+    await reply(session, f"修改成功：{al[0]} 的别名包含 {al[1:]}")
 
 
-@kick.args_parser
-async def kick_parser(session: CommandSession):
+@setalias.args_parser
+async def setalias_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 1:
-        session.state['pos'] = args[0]
+    if len(args) == 2:
+        session.state['name'] = args[0]
+        session.state['aliases'] = args[1]
 
 
-@on_command('kickall', aliases=('清场', 'qc'), only_to_me=False, permission=perm.GROUP)
-async def kickall(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
+@on_command('importrules', aliases=('导入规则'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False, level=1, denied="您没有权限导入规则")
+async def importrules(session: CommandSession, ctx: Context):
+    if 'text' not in session.state:
+        await reply(session, "用法：importrules 后接JSON或TOML格式的规则列表，格式同 exportrules 的输出")
         return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
+    data, error = ruleset.read(session.state['text'])
+    if error is not None:
+        await reply(session, error)
         return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
+    await fresh_rules()
+    entries, errors = ruleset.validate(data, lambda name: rules.find(name) is not None)
+    if errors:
+        await reply(session, "没有导入任何规则：\n" + ruleset.explain(errors))
         return
-    if permission(user_id) < 1:
-        await send_at(session, "你没有权限")
+    if not entries:
+        await reply(session, "没有要导入的规则")
+        return
+    try:
+        loaded = await repo.import_rules(entries)
+    except sqlite3.IntegrityError:
+        # another shard took one of the names since the cache was loaded
+        await reply(session, "没有导入任何规则：规则名或别名已被使用，请重试")
         return
+    rules.load(*loaded)
+    rules_changed()
+    await reply(session, f"成功导入{len(entries)}个规则")
 
-    g = game[group_id]
-    if g.running:
-        if not session.state['force']:
-            await send_at(session, "已经开始")
-            return
 
-    for i in game[group_id].player:
-        in_game[i] = False
-    g.player = [0] * (g.player_num + 1)
-    g.running = False
-    g.alive = [True]*(g.player_num+1)
+@importrules.args_parser
+async def importrules_parser(session: CommandSession):
+    text = session.current_arg_text.strip()
+    if text:
+        session.state['text'] = text
 
-    await send_at(session, "已全部踢出")
-    return
 
+@on_command('exportrules', aliases=('导出规则'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False, level=1, denied="您没有权限导出规则")
+async def exportrules(session: CommandSession, ctx: Context):
+    if session.event.group_id:
+        await reply(session, "请私聊bot使用 exportrules")
+        return
+    body = await repo.export_rules()
+    write = ruleset.write_toml if session.state.get('format') == 'toml' else ruleset.write_json
+    pieces = ruleset.pieces(write(body), getattr(config, 'WEREWOLF_EXPORT_MESSAGE_SIZE', 3000))
+    if len(pieces) > getattr(config, 'WEREWOLF_EXPORT_MAX_MESSAGES', 10):
+        await reply(session, f"共{len(body)}个规则，太多了，请在服务器上用 tools/rules.py export 导出")
+        return
+    if len(pieces) > 1:
+        await reply(session, f"共{len(body)}个规则，分{len(pieces)}条发送，按顺序拼接即为完整内容")
+    for one in pieces:
+        await reply(session, one)
 
-@kickall.args_parser
-async def kickall_parser(session: CommandSession):
+
+@exportrules.args_parser
+async def exportrules_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 1 and args[0] == "--force":
-        session.state['force'] = True
-    else:
-        session.state['force'] = False
+    if len(args) == 1:
+        session.state['format'] = args[0].lower()
 
 
-@on_command('kill', aliases=('杀'), only_to_me=False, permission=perm.GROUP)
-async def kill(session: CommandSession):
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if not group_id:
-        await session.send('请在群聊中使用狼人杀功能')
-        return
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-    if group_id not in game:
-        await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-        return
-    g = game[group_id]
-    if g.running:
-        if user_id != g.player[0]:
-            await send_at(session, "你不是法官，无权操作")
-            return
-        else:
-
-            if 'pos' not in session.state:
-                await send_at(session, "用法：#kill 位置\n如： #kill 1")
-                return
-            try:
-                pos = int(session.state['pos'])
-            except ValueError:
-                await send_at(session, "位置为一个[1..人数]之间的整数")
-                return
-            if not (1 <= pos and pos <= g.player_num):
-                await send_at(session, "位置为一个[1..人数]之间的整数")
-                return
-            if not g.alive[pos]:
-                await send_at(session, "{}号已经死过了。".format(pos))
-                return
-            g.alive[pos] = False
-            s = "当前还活着的有：\n"
-
-            for i in range(g.player_num):
-                if g.alive[i+1]:
-                    s += f"{i+1}号：{g.role[g.identity[i]][0]}\n"
-            await send_private(g.player[0], s)
-            await send_at(session, "{}号 死了。\n".format(pos)+g.preview())
-            return
-    else:
-        await send_at(session, "未开始")
+@on_command('grant', aliases=('授权'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False)
+async def grant(session: CommandSession, ctx: Context):
+    if 'qq' not in session.state:
+        await reply(session, "用法：grant qq 权限等级(默认为1，0表示撤销)")
         return
+    try:
+        qq = int(session.state['qq'])
+        level = int(session.state['level'])
+        if level < 0:
+            raise ValueError
+    except ValueError:
+        await reply(session, "qq和权限等级都是>=0的整数")
+        return
+    mine = await ctx.level()
+    if mine <= level or mine <= await permission(qq):
+        await reply(session, "您没有权限修改此用户的权限")
+        return
+    await permissions.set(qq, level)
+    permissions_changed()
+    await reply(session, f"已将 {qq} 的权限设为 {level}")
 
 
-@kill.args_parser
-async def kill_parser(session: CommandSession):
+@grant.args_parser
+async def grant_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 1:
-        session.state['pos'] = args[0]
+    if len(args) in (1, 2):
+        session.state['qq'] = args[0]
+        session.state['level'] = args[1] if len(args) == 2 else '1'
 
 
-@on_command('addrole', aliases=('新建规则'), only_to_me=False, permission=perm.EVERYBODY)
-async def addrole(session: CommandSession):
-    user_id = session.event.user_id
-    if permission(user_id) < 1:
-        await reply(session, "您没有权限添加规则")
+@on_command('revoke', aliases=('撤销权限'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False)
+async def revoke(session: CommandSession, ctx: Context):
+    if 'qq' not in session.state:
+        await reply(session, "用法：revoke qq")
         return
-    if 'args' not in session.state:
-        await reply(session, "用法：addrole 规则名 好人阵营的身份列表 狼人阵营(夜里见面)的身份列表 狼人阵营(夜里不见面)的身份列表，其中列表用逗号而非空格隔开，如果没有用单一个逗号即可")
+    try:
+        qq = int(session.state['qq'])
+    except ValueError:
+        await reply(session, "qq是一个整数")
         return
-    args = session.state['args']
-    name = args[0]
-    if len(c.execute("select id from roles_alias where name=?", (name,)).fetchall()) > 0:
-        await reply(session, "规则已存在")
+    if await ctx.level() <= await permission(qq):
+        await reply(session, "您没有权限修改此用户的权限")
+        return
+    await permissions.set(qq, 0)
+    permissions_changed()
+    await reply(session, f"已撤销 {qq} 的权限")
 
-    identity = []
-    for i in range(1, 4):
-        for one in re.split(",|，", args[i]):
-            if len(one):
-                if one in identity:
-                    await reply(session, "同一种身份不能在不同阵营中")
-                    return
-        for one in re.split(",|，", args[i]):
-            if len(one):
-                identity.append(one)
-
-    if len(identity) > 20:
-        await reply(session, "😅")
-        return
-
-    identity = []
-    count = []
-    for i in range(1, 4):
-        for one in re.split(",|，", args[i]):
-            if len(one):
-                if not one in identity:
-                    identity.append(one)
-                    count.append([i, 1])
-                else:
-                    count[identity.index(one)][1] += 1
-
-    c.execute("insert into roles (name) values (?)", (name,))
-    _id = c.lastrowid
-    c.execute("insert into roles_alias (id,name) values (?,?)", (_id, name))
-    message = f"规则 {name} 创建成功，包含"
-    for i in range(len(identity)):
-        message += identity[i]
-        if count[i][1] > 1:
-            message += f"*{count[i][1]}"
-        message += ','
-        for j in range(count[i][1]):
-            c.execute("insert into roles_identity (id,name,type) values (?,?,?)",
-                      (_id, identity[i], count[i][0]))
-    message = message[:-1]
-    db.commit()
-    await reply(session, message)
 
+@revoke.args_parser
+async def revoke_parser(session: CommandSession):
+    args = session.current_arg_text.strip().split()
+    if len(args) == 1:
+        session.state['qq'] = args[0]
 
-@addrole.args_parser
-async def addrole_parser(session: CommandSession):
+
+def win_rate(decided, wins):
+    if decided == 0:
+        return "-"
+    return f"{wins*100//decided}%"
+
+
+@on_command('stats', aliases=('战绩'), only_to_me=False, permission=perm.EVERYBODY)
+@instrumented
+async def stats(session: CommandSession):
+    qq = session.event.user_id
+    if 'qq' in session.state:
+        try:
+            qq = int(session.state['qq'])
+        except ValueError:
+            await reply(session, "用法：stats [qq]")
+            return
+    rows = await repo.user_stats(qq)
+    if len(rows) == 0:
+        await reply(session, f"{qq} 还没有战绩")
+        return
+    camp = {}
+    total = [0, 0, 0]
+    s = ""
+    for role, c, games, decided, wins in rows:
+        one = camp.setdefault(1 if c == 1 else 2, [0, 0, 0])
+        for l in (one, total):
+            l[0] += games
+            l[1] += decided
+            l[2] += wins
+        s += f"\n{role}：{games}场，胜率{win_rate(decided, wins)}"
+    head = f"{qq} 共{total[0]}场，胜率{win_rate(total[1], total[2])}"
+    for c in sorted(camp):
+        head += f"\n{CAMPS[c]}阵营：{camp[c][0]}场，胜率{win_rate(camp[c][1], camp[c][2])}"
+    await reply(session, head + s)
+
+
+@stats.args_parser
+async def stats_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 4:
-        session.state['args'] = args
+    if len(args) == 1:
+        session.state['qq'] = re.sub(r"\[CQ:at,qq=(\d+)\]", r"\1", args[0])
+
+
+@on_command('rank', aliases=('排行'), only_to_me=False, permission=perm.GROUP)
+@guard()
+async def rank(session: CommandSession, ctx: Context):
+    rows = await repo.group_rank(ctx.group_id, 10)
+    if len(rows) == 0:
+        await send_at(session, "本群还没有战绩")
+        return
+    s = "本群胜场排行：\n"
+    for i in range(len(rows)):
+        qq, games, decided, wins = rows[i]
+        s += f"{i+1}. {qq}：{wins}胜/{games}场，胜率{win_rate(decided, wins)}\n"
+    await send_at(session, s[:-1])
+
+
+def describe_entry(one):
+    t, group_id, command, uid, text = one[:5]
+    s = time.strftime('%m-%d %H:%M:%S ', time.localtime(t))
+    if command == 'remove':
+        return s + "本桌被清除"
+    if command == 'abort':
+        return s + "对局被强制中止"
+    if command == 'expire':
+        return s + "阶段时间到"
+    if command == 'end':
+        return s + "游戏结束" + (f"，{text}阵营获胜" if text else "")
+    s += f"{uid}：#{command} {text}".rstrip()
+    if len(one) > 5:
+        s += "\n  身份：" + "，".join(f"{i+1}号{name}" for i, name in enumerate(one[5]))
+    return s
+
+
+@on_command('replay', aliases=('回放'), only_to_me=False, permission=perm.EVERYBODY)
+@instrumented
+async def replay(session: CommandSession):
+    if 'game' not in session.state:
+        await reply(session, "用法：replay 对局编号，只能回放自己参加过的对局")
+        return
+    uid = session.event.user_id
+    try:
+        game_id = int(session.state['game'])
+    except ValueError:
+        await reply(session, "对局编号是一个整数")
+        return
+    if not await repo.played(game_id, uid) and await permission(uid) < 1:
+        await reply(session, "只能回放自己参加过的对局")
+        return
+    shards = range(shard[1]) if shard else ()
+    others = [f"{events_path}.{i}" for i in shards if i != shard[0]]
+    sent = 0
+    async for entries in events.replay(game_id, others):
+        s = "\n".join(describe_entry(one) for one in entries)
+        if sent == 0:
+            s = f"第{game_id}局(群{entries[0][1]})的记录：\n" + s
+        await send_private(session.event.self_id, uid, s)
+        sent += len(entries)
+    if sent == 0:
+        await reply(session, "没有这局的记录")
+    elif session.event.group_id:
+        await reply(session, f"已私聊发送第{game_id}局的{sent}条记录")
+
+
+@replay.args_parser
+async def replay_parser(session: CommandSession):
+    args = session.current_arg_text.strip().split()
+    if len(args) == 1:
+        session.state['game'] = args[0]
 
 
-@on_command('setalias', aliases=('设置规则别名'), only_to_me=False, permission=perm.EVERYBODY)
-async def setalias(session: CommandSession):
-    user_id = session.event.user_id
-    if permission(user_id) < 1:
-        await reply(session, "您没有权限设置规则别名")
-        return
-    if 'name' not in session.state:
-        await reply(session, "用法：setalias 规则名 规则的别名 (用逗号分隔开)")
+balance_pool = None
+# rule id -> (identities, future of (wins, games)), shared by concurrent askers
+balances = {}
+
+
+def balance_executor():
+    global balance_pool
+    if balance_pool is None:
+        balance_pool = ProcessPoolExecutor(getattr(config, 'WEREWOLF_BALANCE_WORKERS', 2),
+                                           multiprocessing.get_context('spawn'))
+    return balance_pool
+
+
+@nonebot.get_bot().server_app.after_serving
+async def stop_balance():
+    if balance_pool is not None:
+        balance_pool.shutdown(wait=False)
+
+
+async def simulate(identities):
+    games = getattr(config, 'WEREWOLF_BALANCE_GAMES', 20000)
+    workers = getattr(config, 'WEREWOLF_BALANCE_WORKERS', 2)
+    loop = asyncio.get_running_loop()
+    chunks = [games // workers + (i < games % workers) for i in range(workers)]
+    wins = await asyncio.gather(*[
+        loop.run_in_executor(balance_executor(), balance.simulate, identities, chunk,
+                             random.randrange(2**32))
+        for chunk in chunks if chunk])
+    return sum(wins), games
+
+
+@on_command('balance', aliases=('平衡'), only_to_me=False, permission=perm.EVERYBODY)
+@instrumented
+async def board_balance(session: CommandSession):
+    if 'rule' not in session.state:
+        await reply(session, "用法：balance 规则名")
         return
-    name = session.state['name']
-    aliases = split(session.state['aliases'])
-    _id = c.execute("select id from roles_alias where name=?",
-                    (name,)).fetchall()
-    if len(_id) == 0:
-        await reply(session, "找不到规则")
+    await fresh_rules()
+    name = session.state['rule']
+    rule_id = rules.find(name)
+    if rule_id is None:
+        await reply(session, "找不到这个规则")
         return
-    _id = _id[0][0]
-    for i in aliases:
-        if len(i):
-            sel = c.execute(
-                "select id from roles_alias where name=?", (i,)).fetchall()
-            if len(sel) != 0 and sel[0][0] != _id:
-                await reply(session, "设置的别名不能和其它规则相同")
-                return
-    c.execute("delete from roles_alias where id=?", (_id,))
-    al = [c.execute("select name from roles where id=?",
-                    (_id,)).fetchall()[0][0]]
-    if al[0] != name:
-        al.append(name)
-    for i in aliases:
-        if len(i):
-            if not i in al:
-                al.append(i)
-    for i in al:
-        c.execute("insert into roles_alias (id,name) values (?,?)", [_id, i])
-    db.commit()
-    await reply(session, f"修改成功：{al[0]} 的别名包含 {al[1:]}")
+    identities = rules.identities(rule_id)
+    cached = balances.get(rule_id)
+    if cached is None or cached[0] != identities:
+        cached = balances[rule_id] = (identities, asyncio.ensure_future(simulate(identities)))
+    try:
+        wins, games = await asyncio.shield(cached[1])
+    except Exception:
+        if balances.get(rule_id) is cached:
+            del balances[rule_id]
+        raise
+    await reply(session, balance.report(name, wins, games))
 
 
-@setalias.args_parser
-async def setalias_parser(session: CommandSession):
+@board_balance.args_parser
+async def balance_parser(session: CommandSession):
     args = session.current_arg_text.strip().split()
-    if len(args) == 2:
-        session.state['name'] = args[0]
-        session.state['aliases'] = args[1]
+    if len(args) == 1:
+        session.state['rule'] = args[0]
+
+
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(one, seen) for one in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, one), seen) for one in obj.__slots__)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+@on_command('memory', aliases=('内存'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False, level=1)
+async def memory(session: CommandSession, ctx: Context):
+    running = sum(1 for g in game.values() if g.running)
+    seated = sum(len(g.seat) for g in game.values())
+    s = f"桌数：{len(game)}(进行中{running})\n"
+    s += f"在座人数：{seated}，in_game条目：{len(in_game)}\n"
+    s += f"桌面数据约{deep_size(game) // 1024}KB，in_game约{deep_size(in_game) // 1024}KB\n"
+    s += f"发送队列：{outbox.stats()}"
+    if resource is not None:
+        s += f"\n进程峰值内存：{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024}MB"
+    await reply(session, s)
 
 
 @on_command('rand', aliases=('随机'), only_to_me=False, permission=perm.EVERYBODY)
+@instrumented
 async def rand(session: CommandSession):
     if 'n' not in session.state:
         await reply(session, "用法：rand n 表示随机一个1..n内的整数")
@@ -709,7 +955,7 @@ async def rand(session: CommandSession):
             return
 
     if not session.event.group_id:
-        await session.send(str(random.randint(1, n)))
+        await send(session, str(random.randint(1, n)))
         return
     await send_at(session, str(random.randint(1, n)))
 
@@ -721,116 +967,16 @@ async def rand_parser(session: CommandSession):
         session.state['n'] = args[0]
 
 
-vote_usage = """用法：群中#vote start #vote end表示开始投票和结束投票
-私聊bot#vote x表示给x号投票(一经投票不能修改)
-法官私聊bot#vote x表示删除x号的投票
-"""
+@on_command('act', aliases=('行动', 'xd'), only_to_me=False, permission=perm.EVERYBODY)
+@guard(group=False)
+async def act(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'act')
 
 
 @on_command('vote', aliases=('投票'), only_to_me=False, permission=perm.EVERYBODY)
-async def vote(session: CommandSession):
-    if 'text' not in session.state:
-        await reply(session, vote_usage)
-    text = session.state['text']
-    group_id = session.event.group_id
-    user_id = session.event.user_id
-    if user_id == 80000000:
-        await session.send('请解除匿名后再使用狼人杀功能')
-        return
-
-    if not group_id:
-
-        text = int(text)
-        if not in_game[user_id]:
-            await reply(session, "你没有加入游戏")
-            return
-        group_id = in_game[user_id]
-        g = game[group_id]
-        if not g.running:
-            await reply(session, "游戏未开始")
-            return
-        pos = g.player.index(user_id)
-        try:
-            text = int(text)
-            if text < 0 or text > g.player_num:
-                raise ValueError
-        except ValueError:
-            await reply(session, vote_usage)
-            return
-        if pos == 0:
-            if not g.alive[text]:
-                await reply(session, f"{text}号已经死了")
-                return
-            if g.vote[text] == -1:
-                await reply(session, f"{text}号没有投票")
-                return
-            g.vote[text] = -1
-
-            await send_private(g.player[text], "您的票被法官删除")
-            notvoted = []
-            for i in range(1, g.player_num+1):
-                if g.alive[i] and g.vote[i] == -1:
-                    notvoted.append(i)
-            await reply(session, f"{text}号的票已被删除,还有{notvoted}号没投票")
-        else:
-            if not g.alive[pos]:
-                await reply(session, "你已经死了")
-                return
-            if not g.alive[text] and text > 0:
-                await reply(session, f"{text}号已经死了")
-                return
-            if g.vote[pos] >= 0:
-                await reply(session, "你已经投过票了")
-                return
-            g.vote[pos] = text
-            await reply(session, f"{pos}->{text}")
-            notvoted = []
-            for i in range(1, g.player_num+1):
-                if g.alive[i] and g.vote[i] == -1:
-                    notvoted.append(i)
-            await send_private(g.player[0], f"{pos}号投给{text}号，还有{notvoted}号没有投票")
-    else:
-        if group_id not in game:
-            await send_at(session, '当前群还没有人使用狼人杀功能，请使用set命令开始')
-            return
-        g = game[group_id]
-        if not g.running:
-            await reply(session, "未开始")
-            return
-        if user_id != g.player[0]:
-            await reply(session, "只有法官可以使用此命令")
-            return
-        if text == "start":
-            if g.onVote:
-                await send_at(session, "上一次投票还没结束")
-                return
-            g.onVote = True
-            g.vote = [-1]*(g.player_num+1)
-            await send_at(session, "法官开启了投票，请私聊bot #vote x表示向x号投票(其中vote 0表示弃票，一经投票不能修改)")
-        elif text == "end":
-            if not g.onVote:
-                await send_at(session, "未开启投票")
-                return
-            g.onVote = False
-            vote = [[] for i in range(g.player_num+1)]
-            for i in range(1, g.player_num+1):
-                if g.alive[i]:
-                    vote[max(g.vote[i], 0)].append(i)
-            text = "投票结果：\n"
-            for i in range(g.player_num+1):
-                if len(vote[i]):
-                    text += f"{i} <- {vote[i]}\n"
-            text = text[:-1]
-            await send_at(session, text)
-        else:
-            await send_at(session, vote_usage)
-
-
-@vote.args_parser
-async def vote_parser(session: CommandSession):
-    args = session.current_arg_text.strip().split()
-    if len(args) == 1:
-        session.state['text'] = args[0]
+@guard(group=False)
+async def vote(session: CommandSession, ctx: Context):
+    await play(session, ctx, 'vote')
 
 
 @on_request('friend')
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+import time
+
+# bot.py imports this first, so everything is timed from here
+began = time.perf_counter()
+marks = []
+
+
+def mark(name):
+    marks.append((name, time.perf_counter()))
+
+
+def report():
+    parts = []
+    last = began
+    for name, at in marks:
+        parts.append(f"{name} {at - last:.3f}s")
+        last = at
+    return f"startup took {last - began:.3f}s: " + ", ".join(parts)
+
+
+def profile(func, limit=30):
+    """Runs func() under cProfile and prints the slowest calls by cumulative time."""
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(limit)
+    return result
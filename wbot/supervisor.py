@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from collections import deque
+from quart import Quart, websocket
+from wbot.werewolf.shard import IndexMirror, SeatIndex, route
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (AcceptConnection, CloseConnection, Ping,
+                            RejectConnection, Request, TextMessage)
+import asyncio
+import itertools
+import json
+import logging
+import subprocess
+import sys
+
+logger = logging.getLogger('werewolf.supervisor')
+
+
+class Link:
+    """Client end of a reverse websocket to one worker, speaking like go-cqhttp."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ws = WSConnection(ConnectionType.CLIENT)
+
+    @classmethod
+    async def open(cls, port, headers):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        link = cls(reader, writer)
+        writer.write(link.ws.send(Request(
+            host=f'127.0.0.1:{port}', target='/ws/',
+            extra_headers=[(k.encode(), v.encode()) for k, v in headers.items()])))
+        async for event in link.events():
+            if isinstance(event, AcceptConnection):
+                return link
+            if isinstance(event, RejectConnection):
+                break
+        writer.close()
+        raise ConnectionError(f'worker on port {port} refused the connection')
+
+    async def events(self):
+        while True:
+            data = await self.reader.read(65536)
+            self.ws.receive_data(data or None)
+            for event in self.ws.events():
+                if isinstance(event, Ping):
+                    self.writer.write(self.ws.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    return
+                else:
+                    yield event
+            if not data:
+                return
+
+    async def messages(self):
+        text = []
+        async for event in self.events():
+            if isinstance(event, TextMessage):
+                text.append(event.data)
+                if event.message_finished:
+                    yield ''.join(text)
+                    text = []
+
+    def send(self, text):
+        self.writer.write(self.ws.send(TextMessage(data=text)))
+
+    def close(self):
+        self.writer.close()
+
+
+class Channel:
+    """
+    One upstream connection's line to one worker. Reconnects whenever the
+    worker goes away; up to backlog messages arriving meanwhile are held
+    and passed on once it is back, older ones are dropped.
+    """
+
+    def __init__(self, shard, port, headers, upstream, backlog=1000):
+        self.shard = shard
+        self.port = port
+        self.headers = headers
+        self.upstream = upstream
+        self.link = None
+        self.backlog = deque(maxlen=backlog)
+
+    async def run(self):
+        delay = 0.2
+        while True:
+            try:
+                self.link = await Link.open(self.port, self.headers)
+            except OSError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            delay = 0.2
+            while self.backlog:
+                self.link.send(self.backlog.popleft())
+            try:
+                async for text in self.link.messages():
+                    await self.upstream(self.shard, text)
+            finally:
+                self.link.close()
+                self.link = None
+            logger.warning(f'lost connection to shard {self.shard}')
+
+    def send(self, text):
+        if self.link is None:
+            if len(self.backlog) == self.backlog.maxlen:
+                logger.warning(f'shard {self.shard} is down, dropped {self.backlog[0][:80]}')
+            self.backlog.append(text)
+            return
+        self.link.send(text)
+
+
+class Supervisor:
+    """
+    Runs shards copies of bot.py, each on its own port, and stands between
+    go-cqhttp and them: events are routed by group (private messages by the
+    group the user sits in, see route()), API calls from a worker are passed
+    up with their echo rewritten so the answer finds its way back.
+    """
+
+    def __init__(self, script, shards, host, port, index_path, poll_interval=0.1):
+        self.script = script
+        self.shards = shards
+        self.host = host
+        self.port = port
+        # routing reads the seats from memory, never from SQLite on the loop
+        self.index = IndexMirror(SeatIndex(index_path), poll_interval)
+        self.workers = [None] * shards
+        self.seq = itertools.count(1)
+        self.app = Quart(__name__)
+        self.app.websocket('/ws/')(self.upstream)
+        self.app.before_serving(self.start)
+        self.app.after_serving(self.stop)
+
+    def worker_port(self, shard):
+        return self.port + 1 + shard
+
+    def spawn(self, shard):
+        self.workers[shard] = subprocess.Popen(
+            [sys.executable, self.script, '--shard', str(shard),
+             '--shards', str(self.shards), '--port', str(self.worker_port(shard))])
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for shard, worker in enumerate(self.workers):
+                if worker.poll() is not None:
+                    logger.error(f'shard {shard} exited with {worker.returncode}, restarting')
+                    self.spawn(shard)
+
+    async def start(self):
+        # workers publish their seats again from their journals
+        await self.index.reset()
+        self.index.start()
+        for shard in range(self.shards):
+            self.spawn(shard)
+        self.watcher = asyncio.ensure_future(self.watch())
+
+    async def stop(self):
+        self.watcher.cancel()
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        await self.index.close()
+
+    async def upstream(self):
+        role = websocket.headers.get('X-Client-Role', '').lower()
+        if role != 'universal':
+            logger.error(f'only universal connections can be sharded, got {role!r}')
+            return
+        ws = websocket._get_current_object()
+        headers = {k: websocket.headers[k] for k in
+                   ('X-Self-ID', 'X-Client-Role', 'Authorization')
+                   if k in websocket.headers}
+        calls = {}
+
+        async def call(shard, text):
+            payload = json.loads(text)
+            seq = next(self.seq)
+            calls[seq] = (shard, payload.get('echo'))
+            payload['echo'] = seq
+            await ws.send(json.dumps(payload))
+
+        channels = [Channel(shard, self.worker_port(shard), headers, call)
+                    for shard in range(self.shards)]
+        tasks = [asyncio.ensure_future(one.run()) for one in channels]
+        try:
+            while True:
+                text = await ws.receive()
+                try:
+                    payload = json.loads(text)
+                except ValueError:
+                    continue
+                if 'post_type' in payload:
+                    for shard in route(payload, self.shards, self.index):
+                        channels[shard].send(text)
+                elif isinstance(payload.get('echo'), int) and payload['echo'] in calls:
+                    shard, payload['echo'] = calls.pop(payload['echo'])
+                    channels[shard].send(json.dumps(payload))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run(self):
+        self.app.run(host=self.host, port=self.port)
+
+
+def supervise(script, shards, host, port, index_path, poll_interval=0.1):
+    Supervisor(script, shards, host, port, index_path, poll_interval).run()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+import time
+
+# seconds each phase waits for actions before it resolves without them
+TIMINGS = {'night': 60, 'witch': 30, 'hunter': 30, 'day': 180, 'vote': 60}
+VERBS = {'杀': 'kill', 'kill': 'kill', '验': 'check', 'check': 'check',
+         '守': 'guard', 'guard': 'guard', '救': 'save', 'save': 'save',
+         '毒': 'poison', 'poison': 'poison', '开枪': 'shoot', 'shoot': 'shoot',
+         '过': 'pass', 'pass': 'pass'}
+SEER = '预言家'
+WITCH = '女巫'
+GUARD = '守卫'
+HUNTER = '猎人'
+# deadlines in a row that pass without anyone acting or voting before the game is called off
+IDLE_PHASES = 4
+
+
+def role_of(g, seat):
+    return g.role[g.identity[seat-1]]
+
+
+def holders(g, name):
+    return [seat for seat in g.alive_seats() if role_of(g, seat)[0] == name]
+
+
+def wolves(g):
+    return [seat for seat in g.alive_seats() if role_of(g, seat)[1] == 2]
+
+
+class Moderator:
+    """
+    Runs a table without a judge. Night: the wolves that meet (camp 2) pick
+    a victim, the seer checks, the guard guards; then the witch may save or
+    poison; day: discussion, then a vote with at most one runoff. A killed
+    hunter may shoot unless poisoned. Every method takes the Game and
+    returns the effects to deliver, (uid, text) with uid None for the group.
+    step changes on every transition, so a deadline set for an earlier step
+    is recognised and ignored by expire(). phase is None before the game
+    starts and once winner is decided; winner 0 means the game was called
+    off after IDLE_PHASES deadlines without input (heard is the last step
+    anyone acted or voted in, discussion does not count either way).
+    """
+
+    __slots__ = ('phase', 'step', 'deadline', 'night', 'kills', 'acted',
+                 'guard', 'guarded', 'antidote', 'poison', 'victim', 'saved',
+                 'poisoned', 'hunter', 'then', 'winner', 'idle', 'heard')
+
+    def __init__(self):
+        self.phase = None
+        self.step = 0
+        self.deadline = 0
+        self.night = 0
+        self.kills = {}
+        self.acted = set()
+        self.guard = 0
+        self.guarded = 0
+        self.antidote = True
+        self.poison = True
+        self.victim = 0
+        self.saved = False
+        self.poisoned = 0
+        self.hunter = 0
+        self.then = None
+        self.winner = None
+        self.idle = 0
+        self.heard = 0
+
+    def enter(self, phase):
+        self.phase = phase
+        self.step += 1
+        self.deadline = time.time() + TIMINGS[phase]
+
+    def begin(self, g):
+        return [(None, "本局由bot自动主持，夜间行动请私聊bot #act，投票请私聊bot #vote")] + \
+            self.nightfall(g)
+
+    def nightfall(self, g):
+        self.night += 1
+        self.kills = {}
+        self.acted = set()
+        self.guard = 0
+        self.victim = 0
+        self.saved = False
+        self.poisoned = 0
+        self.enter('night')
+        effects = [(None, f"第{self.night}夜，天黑请闭眼，请有夜间行动的玩家在{TIMINGS['night']}秒内行动")]
+        pack = wolves(g)
+        for seat in pack:
+            effects.append((g.player[seat], f"请私聊bot #act 杀 x 选择今晚的目标，狼队友为{pack}"))
+        for seat in holders(g, SEER):
+            effects.append((g.player[seat], "请私聊bot #act 验 x 查验x号的身份"))
+        for seat in holders(g, GUARD):
+            effects.append((g.player[seat], "请私聊bot #act 守 x 守护x号(0表示空守，不能连续两晚守同一人)"))
+        if self.night_done(g):
+            effects += self.night_over(g)
+        return effects
+
+    def night_done(self, g):
+        actors = wolves(g) + holders(g, SEER) + holders(g, GUARD)
+        return all(seat in self.acted for seat in actors)
+
+    def night_over(self, g):
+        tally = {}
+        for target in self.kills.values():
+            tally[target] = tally.get(target, 0) + 1
+        if tally:
+            top = max(tally.values())
+            # ties go to the lowest seated wolf's choice
+            self.victim = next(self.kills[seat] for seat in sorted(self.kills)
+                               if tally[self.kills[seat]] == top)
+        witch = holders(g, WITCH)
+        if not witch or not (self.antidote or self.poison):
+            return self.dawn(g)
+        self.enter('witch')
+        s = ""
+        if self.antidote:
+            s += f"今晚{self.victim}号被杀，#act 救 使用解药；" if self.victim else "今晚没有人被杀；"
+        if self.poison:
+            s += "#act 毒 x 对x号使用毒药；"
+        s += f"#act 过 不使用药，{TIMINGS['witch']}秒内有效"
+        return [(g.player[seat], s) for seat in witch]
+
+    def dawn(self, g):
+        dead = []
+        if self.victim and not (self.saved ^ (self.victim == self.guard)):
+            dead.append(self.victim)
+        if self.poisoned and self.poisoned not in dead:
+            dead.append(self.poisoned)
+        self.guarded = self.guard
+        for seat in dead:
+            g.kill(seat)
+        s = f"天亮了，昨晚{sorted(dead)}号死亡" if dead else "天亮了，昨晚是平安夜"
+        return self.after_deaths(g, dead, 'day', [(None, s)])
+
+    def check(self, g):
+        bad = sum(1 for seat in g.alive_seats() if role_of(g, seat)[1] != 1)
+        if bad == 0:
+            self.winner = 1
+        elif bad >= g.alive_count - bad:
+            self.winner = 2
+        else:
+            return False
+        self.phase = None
+        self.step += 1
+        return True
+
+    def after_deaths(self, g, dead, then, effects):
+        if self.check(g):
+            return effects
+        hunters = [seat for seat in dead
+                   if role_of(g, seat)[0] == HUNTER and seat != self.poisoned]
+        if hunters:
+            self.hunter = hunters[0]
+            self.then = then
+            self.enter('hunter')
+            effects.append((None, f"{self.hunter}号是猎人，可以在{TIMINGS['hunter']}秒内开枪"))
+            effects.append((g.player[self.hunter], "请私聊bot #act 开枪 x 带走x号，或 #act 过 不开枪"))
+            return effects
+        return effects + self.proceed(g, then)
+
+    def proceed(self, g, then):
+        if then == 'day':
+            self.enter('day')
+            return [(None, f"请存活玩家依次发言，{TIMINGS['day']}秒后开始投票")]
+        return self.nightfall(g)
+
+    def polls(self, g):
+        g.start_vote()
+        self.enter('vote')
+        return [(None, f"开始投票，请在{TIMINGS['vote']}秒内私聊bot #vote x向x号投票(0表示弃票，一经投票不能修改)")]
+
+    def voted(self, g):
+        self.heard = self.step
+        self.idle = 0
+        if self.phase != 'vote' or g.round is None or g.round.not_voted():
+            return []
+        return self.count(g)
+
+    def count(self, g):
+        r = g.end_vote()
+        effects = [(None, r.describe())]
+        leaders = r.leaders()
+        if len(leaders) > 1 and r.candidates is None:
+            g.start_runoff()
+            self.enter('vote')
+            effects.append((None, f"{leaders}号平票，{leaders}号不能投票，其余玩家请在{TIMINGS['vote']}秒内私聊bot #vote x在{leaders}号中选择(0表示弃票)"))
+            return effects
+        if len(leaders) != 1:
+            effects.append((None, "无人被放逐"))
+            return effects + self.nightfall(g)
+        out = leaders[0]
+        g.kill(out)
+        effects.append((None, f"{out}号被放逐"))
+        return self.after_deaths(g, [out], 'night', effects)
+
+    def expire(self, g, step):
+        if step != self.step:
+            return []
+        if self.phase != 'day':
+            self.idle = 0 if self.heard == step else self.idle + 1
+            if self.idle >= IDLE_PHASES:
+                self.phase = None
+                self.step += 1
+                self.winner = 0
+                return [(None, f"连续{self.idle}个阶段无人行动，游戏自动结束")]
+        if self.phase == 'night':
+            return self.night_over(g)
+        if self.phase == 'witch':
+            return self.dawn(g)
+        if self.phase == 'hunter':
+            self.hunter = 0
+            return [(None, "猎人没有开枪")] + self.proceed(g, self.then)
+        if self.phase == 'day':
+            return self.polls(g)
+        if self.phase == 'vote':
+            return self.count(g)
+        return []
+
+    def act(self, g, seat, text):
+        """Handles "#act text" from seat, returns (reply, effects), effects None if it was rejected."""
+        step = self.step
+        result, effects = self.action(g, seat, text)
+        if effects is not None:
+            self.heard = step
+            self.idle = 0
+        return result, effects
+
+    def action(self, g, seat, text):
+        words = text.split()
+        verb = VERBS.get(words[0]) if words else None
+        try:
+            target = int(words[1]) if len(words) > 1 else None
+        except ValueError:
+            target = None
+        if target is not None and not (0 <= target <= g.player_num):
+            target = None
+        name = role_of(g, seat)[0]
+        if self.phase == 'hunter' and seat == self.hunter:
+            return self.act_hunter(g, verb, target)
+        if not g.alive[seat]:
+            return "你已经死了", None
+        if self.phase == 'night':
+            return self.act_night(g, seat, name, verb, target)
+        if self.phase == 'witch' and name == WITCH:
+            return self.act_witch(g, verb, target)
+        return "现在不是你行动的时候", None
+
+    def act_night(self, g, seat, name, verb, target):
+        alive = target is not None and target > 0 and g.alive[target]
+        if verb == 'kill' and role_of(g, seat)[1] == 2:
+            if not alive:
+                return "请选择一名存活的玩家", None
+            self.kills[seat] = target
+            self.acted.add(seat)
+            effects = [(g.player[one], f"{seat}号选择了{target}号")
+                       for one in wolves(g) if one != seat]
+        elif verb == 'check' and name == SEER:
+            if seat in self.acted:
+                return "你今晚已经查验过了", None
+            if not alive:
+                return "请选择一名存活的玩家", None
+            self.acted.add(seat)
+            effects = [(g.player[seat], f"{target}号是{'好人' if role_of(g, target)[1] == 1 else '狼人'}")]
+        elif verb == 'guard' and name == GUARD:
+            if seat in self.acted:
+                return "你今晚已经守护过了", None
+            if target is None or (target > 0 and not g.alive[target]):
+                return "请选择一名存活的玩家，0表示空守", None
+            if target and target == self.guarded:
+                return "不能连续两晚守护同一名玩家", None
+            self.guard = target
+            self.acted.add(seat)
+            effects = []
+        else:
+            return "现在不是你行动的时候", None
+        if self.night_done(g):
+            effects += self.night_over(g)
+        return "收到", effects
+
+    def act_witch(self, g, verb, target):
+        if verb == 'save':
+            if not self.antidote:
+                return "解药已经用过了", None
+            if not self.victim:
+                return "今晚没有人被杀", None
+            self.antidote = False
+            self.saved = True
+        elif verb == 'poison':
+            if not self.poison:
+                return "毒药已经用过了", None
+            if not target or not g.alive[target]:
+                return "请选择一名存活的玩家", None
+            self.poison = False
+            self.poisoned = target
+        elif verb != 'pass':
+            return "用法：#act 救 / #act 毒 x / #act 过", None
+        return "收到", self.dawn(g)
+
+    def act_hunter(self, g, verb, target):
+        if verb == 'pass':
+            self.hunter = 0
+            return "收到", [(None, "猎人没有开枪")] + self.proceed(g, self.then)
+        if verb != 'shoot':
+            return "用法：#act 开枪 x / #act 过", None
+        if not target or not g.alive[target]:
+            return "请选择一名存活的玩家", None
+        shooter, self.hunter = self.hunter, 0
+        g.kill(target)
+        return "收到", self.after_deaths(g, [target], self.then,
+                                       [(None, f"{shooter}号猎人开枪带走了{target}号")])
+
+    def dump(self):
+        return {
+            'phase': self.phase,
+            'step': self.step,
+            'deadline': self.deadline,
+            'night': self.night,
+            'kills': list(self.kills.items()),
+            'acted': sorted(self.acted),
+            'guard': self.guard,
+            'guarded': self.guarded,
+            'antidote': self.antidote,
+            'poison': self.poison,
+            'victim': self.victim,
+            'saved': self.saved,
+            'poisoned': self.poisoned,
+            'hunter': self.hunter,
+            'then': self.then,
+            'winner': self.winner,
+            'idle': self.idle,
+            'heard': self.heard,
+        }
+
+    @classmethod
+    def load(cls, state):
+        m = cls()
+        for name in cls.__slots__:
+            # tables journaled before a field existed keep its default
+            if name in state:
+                setattr(m, name, state[name])
+        m.kills = dict(state['kills'])
+        m.acted = set(state['acted'])
+        return m
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from math import sqrt
+from wbot.werewolf.auto import GUARD, HUNTER, SEER, WITCH
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# how often the random policies take an optional action
+SAVE = 0.5
+POISON = 0.3
+TRUST = 0.5
+
+
+class Board:
+    """
+    A rule set as the simulator sees it. Every seat plays a random policy:
+    wolves (camp 2) kill a random good player, the guard guards a random
+    player (never the same one twice in a row), the witch saves with
+    probability SAVE or else poisons with POISON, the seer checks a random
+    unchecked player. By day the village exiles a wolf the seer has found
+    with probability TRUST, otherwise a random player. A dead hunter shoots
+    at random unless poisoned. Wins are decided as by the auto Moderator.
+    """
+
+    def __init__(self, identities):
+        self.camps = [camp for name, camp in identities]
+        self.n = len(self.camps)
+        names = [name for name, camp in identities]
+        self.seers = [i for i in range(self.n) if names[i] == SEER]
+        self.witches = [i for i in range(self.n) if names[i] == WITCH]
+        self.guards = [i for i in range(self.n) if names[i] == GUARD]
+        self.hunters = [i for i in range(self.n) if names[i] == HUNTER]
+
+
+def play(board, rnd):
+    """One game with random.Random rnd, returns the winning camp (1 or 2)."""
+    n = board.n
+    camps = board.camps
+    alive = [True] * n
+    antidote = dict.fromkeys(board.witches, True)
+    poison = dict.fromkeys(board.witches, True)
+    last = dict.fromkeys(board.guards, -1)
+    checked = {seer: set() for seer in board.seers}
+    known = set()
+
+    def living(*exclude):
+        return [i for i in range(n) if alive[i] and i not in exclude]
+
+    def kill(i, shoot=True):
+        alive[i] = False
+        if shoot and i in board.hunters and living():
+            kill(rnd.choice(living()))
+
+    def winner():
+        bad = sum(1 for i in range(n) if alive[i] and camps[i] != 1)
+        if bad == 0:
+            return 1
+        if bad >= sum(alive) - bad:
+            return 2
+        return 0
+
+    while True:
+        victim = -1
+        good = [i for i in living() if camps[i] == 1]
+        if good and any(alive[i] and camps[i] == 2 for i in range(n)):
+            victim = rnd.choice(good)
+        guarded = set()
+        for guard in board.guards:
+            choices = [i for i in living() if i != last[guard]]
+            if alive[guard] and choices:
+                last[guard] = rnd.choice(choices)
+                guarded.add(last[guard])
+        saved = False
+        poisoned = -1
+        for witch in board.witches:
+            if not alive[witch]:
+                continue
+            if victim >= 0 and antidote[witch] and not saved and rnd.random() < SAVE:
+                antidote[witch] = False
+                saved = True
+            elif poison[witch] and rnd.random() < POISON and living(witch):
+                poisoned = rnd.choice(living(witch))
+                poison[witch] = False
+        for seer in board.seers:
+            choices = [i for i in living(seer) if i not in checked[seer]]
+            if alive[seer] and choices:
+                target = rnd.choice(choices)
+                checked[seer].add(target)
+                if camps[target] != 1:
+                    known.add(target)
+        if victim >= 0 and not (saved ^ (victim in guarded)):
+            kill(victim)
+        if poisoned >= 0 and alive[poisoned]:
+            kill(poisoned, False)
+        if winner():
+            return winner()
+        found = [i for i in known if alive[i]]
+        if found and rnd.random() < TRUST:
+            kill(rnd.choice(found))
+        else:
+            kill(rnd.choice(living()))
+        if winner():
+            return winner()
+
+
+def pick(rng, mask):
+    """A random True column of every row of mask, and whether the row had one."""
+    keys = rng.random(mask.shape)
+    keys[~mask] = -1.0
+    return keys.argmax(1), mask.any(1)
+
+
+def play_batch(board, games, rng):
+    """play() for games games at once with NumPy, returns how many camp 1 won."""
+    n = board.n
+    rows = numpy.arange(games)
+    seats = numpy.arange(n)
+    camps = numpy.array(board.camps)
+    hunters = numpy.array(board.hunters, dtype=int)
+    alive = numpy.ones((games, n), dtype=bool)
+    done = numpy.zeros(games, dtype=bool)
+    winner = numpy.zeros(games, dtype=numpy.int8)
+    antidote = {witch: numpy.ones(games, dtype=bool) for witch in board.witches}
+    poison = {witch: numpy.ones(games, dtype=bool) for witch in board.witches}
+    last = {guard: numpy.full(games, -1) for guard in board.guards}
+    checked = {seer: numpy.zeros((games, n), dtype=bool) for seer in board.seers}
+    known = numpy.zeros((games, n), dtype=bool)
+
+    def kill(hit, target, shoot=True):
+        alive[rows[hit], target[hit]] = False
+        shooting = hit & numpy.isin(target, hunters) if shoot else hit & False
+        while shooting.any():
+            target, ok = pick(rng, alive)
+            shooting &= ok
+            alive[rows[shooting], target[shooting]] = False
+            shooting &= numpy.isin(target, hunters)
+
+    def decide():
+        bad = (alive & (camps != 1)).sum(1)
+        good = ~done & (bad == 0)
+        wolf = ~done & ~good & (bad >= alive.sum(1) - bad)
+        winner[good] = 1
+        winner[wolf] = 2
+        done[:] |= good | wolf
+
+    while not done.all():
+        live = alive & ~done[:, None]
+        victim, ok = pick(rng, live & (camps == 1))
+        hunting = ok & (live & (camps == 2)).any(1)
+        guarded = numpy.zeros(games, dtype=bool)
+        for guard in board.guards:
+            target, ok = pick(rng, live & (seats != last[guard][:, None]))
+            acting = live[:, guard] & ok
+            last[guard] = numpy.where(acting, target, last[guard])
+            guarded |= acting & (target == victim)
+        saved = numpy.zeros(games, dtype=bool)
+        poisoned = numpy.full(games, -1)
+        for witch in board.witches:
+            acting = live[:, witch]
+            save = acting & hunting & antidote[witch] & ~saved & (rng.random(games) < SAVE)
+            antidote[witch] &= ~save
+            saved |= save
+            target, ok = pick(rng, live & (seats != witch))
+            use = acting & ~save & poison[witch] & (rng.random(games) < POISON) & ok
+            poison[witch] &= ~use
+            poisoned = numpy.where(use, target, poisoned)
+        for seer in board.seers:
+            target, ok = pick(rng, live & ~checked[seer] & (seats != seer))
+            acting = live[:, seer] & ok
+            checked[seer][rows[acting], target[acting]] = True
+            known[rows[acting], target[acting]] |= camps[target[acting]] != 1
+        kill(hunting & ~(saved ^ guarded), victim)
+        hit = (poisoned >= 0) & alive[rows, numpy.maximum(poisoned, 0)]
+        kill(hit, poisoned, False)
+        decide()
+        live = alive & ~done[:, None]
+        found, trusted = pick(rng, known & live)
+        trusted &= rng.random(games) < TRUST
+        anyone, ok = pick(rng, live)
+        kill(~done & ok, numpy.where(trusted, found, anyone))
+        decide()
+    return int((winner == 1).sum())
+
+
+def simulate(identities, games, seed=None):
+    """Plays games random games of a rule's identities, returns how many the good camp won."""
+    board = Board(identities)
+    if numpy is not None:
+        return play_batch(board, games, numpy.random.default_rng(seed))
+    rnd = random.Random(seed)
+    return sum(1 for _ in range(games) if play(board, rnd) == 1)
+
+
+def interval(wins, games, z=1.96):
+    """Wilson score interval of a win rate, 95% by default."""
+    if games == 0:
+        return 0.0, 1.0
+    p = wins / games
+    centre = (p + z*z / (2*games)) / (1 + z*z / games)
+    half = z * sqrt(p*(1-p)/games + z*z / (4*games*games)) / (1 + z*z / games)
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def report(name, wins, games):
+    low, high = interval(wins, games)
+    return (f"{name}：模拟{games}局，好人胜率{wins*100/games:.1f}%"
+            f"(95%置信区间{low*100:.1f}%~{high*100:.1f}%)，"
+            f"狼人胜率{100 - wins*100/games:.1f}%\n"
+            "各身份按随机策略行动，结果仅供参考")
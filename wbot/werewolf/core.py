@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from wbot.werewolf.game import Game, cq_at
+from wbot.werewolf.storage import CAMPS
+import time
+
+NO_TABLE = '当前群还没有人使用狼人杀功能，请使用set命令开始'
+WINNER_ALIAS = {'好人': 1, '好': 1, 'good': 1, '狼人': 2, '狼': 2, 'wolf': 2}
+ACT_USAGE = """用法：由bot主持的对局中，私聊bot
+#act 杀 x：狼人选择今晚的目标
+#act 验 x：预言家查验x号
+#act 守 x：守卫守护x号(0表示空守)
+#act 救 / #act 毒 x / #act 过：女巫使用解药、毒药或不用药
+#act 开枪 x / #act 过：猎人开枪或不开枪"""
+VOTE_USAGE = """用法：群中#vote start #vote end表示开始投票和结束投票
+#vote pk表示在上一轮平票的玩家之间进行PK投票
+#vote sheriff x表示设置x号为警长(投票计1.5票)，x为0表示撤销
+私聊bot#vote x表示给x号投票(一经投票不能修改)
+法官私聊bot#vote x表示删除x号的投票
+"""
+
+COMMANDS = {}
+# commands that need Event.level filled in
+LEVELED = set()
+
+
+class Event:
+    """One command: its name, where it was sent and by whom, its argument text, and the sender's permission level."""
+
+    __slots__ = ('command', 'group_id', 'user_id', 'text', 'level')
+
+    def __init__(self, command, group_id, user_id, text='', level=0):
+        self.command = command
+        self.group_id = group_id
+        self.user_id = user_id
+        self.text = text
+        self.level = level
+
+
+def command(name, table=NO_TABLE, level=0, denied="你没有权限", running=False,
+            judge=None, leveled=False):
+    """
+    Registers a Core handler for name with the checks it needs, run in this
+    order: a table must exist (table is the message otherwise, None to
+    skip), permission level, game running, sender is the judge.
+    """
+    def deco(func):
+        COMMANDS[name] = (func, table, level, denied, running, judge)
+        if level or leveled:
+            LEVELED.add(name)
+        return func
+    return deco
+
+
+def reply(text):
+    return ('reply', text)
+
+
+class Core:
+    """
+    The table commands without any I/O. handle() takes an Event and returns
+    the effects it calls for, in order:
+
+        ('reply', text)                  answer the sender
+        ('group', group_id, text)
+        ('private', user_id, text)
+        ('deal', group_id, [(uid, text)])  identities, see undelivered()
+        ('record', group_id, rule, judge, participants, votes, winner)
+        ('mark', group_id)               table changed, journal it
+        ('log', group_id, entry)         what changed it, for the event log
+        ('arm', group_id) / ('disarm', group_id)  the auto moderator's deadline
+
+    Tables and who sits where live in the game and in_game mappings handed
+    in, so the bot and a simulation share the same code.
+    """
+
+    def __init__(self, game, in_game, rules):
+        self.game = game
+        self.in_game = in_game
+        self.rules = rules
+
+    def handle(self, ev):
+        func, table, level, denied, running, judge = COMMANDS[ev.command]
+        key = ev.group_id or self.in_game.get(ev.user_id)
+        g = self.game.get(key) if key else None
+        if g is not None and not len(g.player):
+            # tables set up before #set checked its arguments
+            g = None
+        seat = None if g is None else g.seat_of(ev.user_id)
+        if table is not None and g is None:
+            return [reply(table)]
+        if level and ev.level < level:
+            return [reply(denied)]
+        if running and not g.running:
+            return [reply("未开始")]
+        if judge is not None and seat != 0:
+            return [reply(judge)]
+        effects = list(func(self, ev, key, g, seat))
+        entry = [ev.command, ev.user_id, ev.text]
+        g = self.game.get(key)
+        if ev.command in ('start', 'remake') and g is not None and g.running:
+            entry.append([g.role[i][0] for i in g.identity])
+        return self.logged(key, entry, effects)
+
+    def logged(self, group_id, entry, effects):
+        """effects with ('log', group_id, entry) before the table's first change, if it changed."""
+        for i, one in enumerate(effects):
+            if one == ('mark', group_id):
+                return effects[:i] + [('log', group_id, entry)] + effects[i:]
+        return effects
+
+    def changed(self, group_id):
+        self.game[group_id].active = time.time()
+        return ('mark', group_id)
+
+    def remove(self, group_id):
+        for uid in self.game[group_id].seat:
+            if self.in_game.get(uid) == group_id:
+                del self.in_game[uid]
+        del self.game[group_id]
+        return [('disarm', group_id), ('log', group_id, ['remove', None, '']), ('mark', group_id)]
+
+    def try_sit(self, g, group_id, uid, pos):
+        result = g.sit(uid, pos)
+        if result != "":
+            yield reply(result)
+            return False
+        self.in_game[uid] = group_id
+        yield self.changed(group_id)
+        return True
+
+    def deal(self, group_id, g):
+        wolf = []
+        if g.online:
+            for i in range(g.player_num):
+                if g.role[g.identity[i]][1] == 2:
+                    wolf.append(i+1)
+        messages = []
+        for i in range(g.player_num):
+            s = f"您是{i+1}号，您的身份是{g.role[g.identity[i]][0]}。"
+            if g.online and g.role[g.identity[i]][1] == 2:
+                s += f"您的狼队友为{wolf}。"
+            messages.append((g.player[i+1], s))
+        if g.auto is None:
+            s = "您是法官，\n"
+            for i in range(g.player_num):
+                s += f"{i+1}号：{g.role[g.identity[i]][0]}\n"
+            s = s[:-1]
+            messages.append((g.player[0], s))
+        return ('deal', group_id, messages)
+
+    def undelivered(self, group_id, failed):
+        """Effects for the uids a ('deal', ...) could not reach."""
+        g = self.game.get(group_id)
+        if g is None or not failed:
+            return []
+        seats = [g.seat_of(uid) for uid in failed]
+        s = f"{seats}号的身份发送失败，请确认已添加bot为好友后使用#resend重发"
+        if 0 in seats or g.auto is not None:
+            return [reply(s)]
+        return [('private', g.player[0], s)]
+
+    def end_game(self, group_id, g, winner, to_group=False):
+        yield ('disarm', group_id)
+        for i in g.seat:
+            self.in_game.pop(i, None)
+        judge, participants, votes = g.record()
+        s = "游戏已结束，身份为：\n"
+        for i in range(g.player_num):
+            s += "{}号({})：{}{}\n".format(i + 1, cq_at(
+                g.player[i + 1]), g.role[g.identity[i]][0], ("" if g.alive[i+1] else "「已死亡」"))
+        g.clear()
+        yield self.changed(group_id)
+        if winner:
+            s += f"{CAMPS[winner]}阵营获胜\n"
+        yield ('group', group_id, s) if to_group else reply(s)
+        yield ('record', group_id, g.roleid, judge, participants, votes, winner)
+
+    def moderate(self, group_id, g, effects):
+        # deadlines alone do not keep a table active, so abandoned games get swept
+        yield ('mark', group_id)
+        for uid, text in effects:
+            yield ('group', group_id, text) if uid is None else ('private', uid, text)
+        if g.auto.winner is not None:
+            yield from self.end_game(group_id, g, g.auto.winner or None, True)
+        else:
+            yield ('arm', group_id)
+
+    def expire(self, group_id, step):
+        """Effects of the auto moderator's deadline for step running out."""
+        g = self.game.get(group_id)
+        if g is None or not g.running or g.auto is None or g.auto.step != step:
+            return []
+        return self.logged(group_id, ['expire', None, str(step)],
+                           list(self.moderate(group_id, g, g.auto.expire(g, step))))
+
+    @command('set', table=None)
+    def set_rule(self, ev, key, g, seat):
+        group_id = ev.group_id
+        user_id = ev.user_id
+        if self.in_game.get(user_id, group_id) != group_id:
+            yield reply("你已经在某个群加入了,请先退出")
+            return
+        if g is not None and not g.empty(user_id):
+            yield reply('当前桌还有人')
+            return
+        args = ev.text.split()
+        auto = len(args) == 3 and args[2].lower() in ('auto', '自动')
+        if len(args) != 2 and not auto:
+            yield reply("用法：#set 规则名 位置 [auto]，加上auto表示由bot主持")
+            return
+        try:
+            pos = int(args[1])
+        except ValueError:
+            yield reply("位置是一个[0..人数]之间的整数")
+            return
+        role_id, names = self.rules.resolve(args[0])
+        if role_id is None:
+            yield reply("找不到这个规则" +
+                        (f"，你要找的是不是：{'、'.join(names)}" if names else ""))
+            return
+        if g is None:
+            g = self.game[group_id] = Game()
+        yield ('disarm', group_id)
+        self.in_game.pop(user_id, None)
+        g.init(role_id, self.rules.identities(role_id), auto=auto)
+        yield self.changed(group_id)
+        if (yield from self.try_sit(g, group_id, user_id, pos)):
+            yield reply((f"没有规则 {args[0]}，已按 {names[0]} " if names else "") +
+                        "创建成功，" + g.preview())
+
+    @command('sit', table='当前群没有设定板子，请使用set命令设置')
+    def sit(self, ev, key, g, seat):
+        if self.in_game.get(ev.user_id, ev.group_id) != ev.group_id:
+            yield reply("你已经在某个群加入了,请先退出")
+            return
+        args = ev.text.split()
+        if len(args) != 1:
+            yield reply("用法：#sit 位置\n如： #sit 1")
+            return
+        try:
+            pos = int(args[0])
+        except ValueError:
+            yield reply("位置为一个[0..人数]之间的整数")
+            return
+        if (yield from self.try_sit(g, ev.group_id, ev.user_id, pos)):
+            yield reply("加入成功，" + g.preview())
+
+    @command('stand')
+    def stand(self, ev, key, g, seat):
+        result = g.stand(ev.user_id)
+        if result != "":
+            yield reply(result)
+            return
+        self.in_game.pop(ev.user_id, None)
+        yield self.changed(ev.group_id)
+        yield reply("退出成功，" + g.preview())
+
+    @command('status')
+    def status(self, ev, key, g, seat):
+        g.active = time.time()
+        yield reply(g.preview())
+
+    @command('start')
+    def start(self, ev, key, g, seat):
+        if seat is None:
+            yield reply("你还没有加入游戏")
+            return
+        if not g.full():
+            yield reply("人数不足，无法开始")
+            return
+        if g.running:
+            yield reply("游戏已经开始")
+            return
+        g.generate()
+        yield self.changed(ev.group_id)
+        yield self.deal(ev.group_id, g)
+        if g.auto is not None:
+            yield from self.moderate(ev.group_id, g, g.auto.begin(g))
+
+    @command('resend', running=True)
+    def resend(self, ev, key, g, seat):
+        if seat != 0 and (g.auto is None or seat is None):
+            yield reply("只有法官可以要求重新发牌")
+            return
+        yield self.deal(ev.group_id, g)
+
+    @command('remake', running=True, judge="只有法官可以要求重新生成身份")
+    def remake(self, ev, key, g, seat):
+        g.generate()
+        yield self.changed(ev.group_id)
+        yield self.deal(ev.group_id, g)
+
+    @command('stop', running=True, leveled=True)
+    def stop(self, ev, key, g, seat):
+        args = ev.text.split()
+        winner = None
+        for one in args:
+            if one in WINNER_ALIAS:
+                winner = WINNER_ALIAS[one]
+        if "--force" in args:
+            if ev.level == 0:
+                yield reply("你没有权限")
+                return
+        elif seat != 0:
+            yield reply("你不是法官，无权结束")
+            return
+        yield from self.end_game(ev.group_id, g, winner)
+
+    @command('kick', level=1, denied="你没有权限踢人")
+    def kick(self, ev, key, g, seat):
+        args = ev.text.split()
+        if len(args) != 1:
+            yield reply("用法：#kick 位置")
+            return
+        try:
+            pos = int(args[0])
+        except ValueError:
+            yield reply("位置为一个[0..人数]之间的整数")
+            return
+        if not (0 <= pos <= g.player_num):
+            yield reply("位置为一个[0..人数]之间的整数")
+        elif g.player[pos] == 0:
+            yield reply("此位置没有人")
+        else:
+            qq = g.player[pos]
+            result = g.stand(qq)
+            if result == "":
+                self.in_game.pop(qq, None)
+                yield self.changed(ev.group_id)
+                yield reply("踢出{}成功，".format(cq_at(qq)) + g.preview())
+            else:
+                yield reply(result)
+
+    @command('kickall', level=1)
+    def kickall(self, ev, key, g, seat):
+        if g.running and ev.text.split() != ["--force"]:
+            yield reply("已经开始")
+            return
+        aborted = g.running
+        for i in g.seat:
+            self.in_game.pop(i, None)
+        g.clear()
+        yield ('disarm', ev.group_id)
+        yield self.changed(ev.group_id)
+        if aborted:
+            # ends the game's timeline in the event log, the next game starts afresh
+            yield ('log', ev.group_id, ['abort', None, ''])
+        yield reply("已全部踢出")
+
+    @command('kill', running=True, judge="你不是法官，无权操作")
+    def kill(self, ev, key, g, seat):
+        args = ev.text.split()
+        if len(args) != 1:
+            yield reply("用法：#kill 位置\n如： #kill 1")
+            return
+        try:
+            pos = int(args[0])
+        except ValueError:
+            yield reply("位置为一个[1..人数]之间的整数")
+            return
+        if not (1 <= pos and pos <= g.player_num):
+            yield reply("位置为一个[1..人数]之间的整数")
+            return
+        if not g.kill(pos):
+            yield reply("{}号已经死过了。".format(pos))
+            return
+        yield self.changed(ev.group_id)
+        s = "当前还活着的有：\n"
+        for i in range(g.player_num):
+            if g.alive[i+1]:
+                s += f"{i+1}号：{g.role[g.identity[i]][0]}\n"
+        yield ('private', g.player[0], s)
+        yield reply("{}号 死了。\n".format(pos)+g.preview())
+
+    @command('act', table="你没有加入游戏", running=True)
+    def act(self, ev, key, g, seat):
+        if ev.group_id:
+            yield reply("请私聊bot使用此命令")
+            return
+        if g.auto is None:
+            yield reply("本桌由法官主持")
+            return
+        if not ev.text:
+            yield reply(ACT_USAGE)
+            return
+        result, effects = g.auto.act(g, seat, ev.text)
+        yield reply(result)
+        if effects is None:
+            return
+        yield self.changed(key)
+        yield from self.moderate(key, g, effects)
+
+    @command('vote', table=None)
+    def vote(self, ev, key, g, seat):
+        args = ev.text.split()
+        if len(args) not in (1, 2):
+            yield reply(VOTE_USAGE)
+            return
+        text = args[0]
+        if not ev.group_id:
+            yield from self.ballot(key, g, seat, text)
+            return
+        if g is None:
+            yield reply(NO_TABLE)
+            return
+        if not g.running:
+            yield reply("未开始")
+            return
+        if seat != 0:
+            yield reply("只有法官可以使用此命令")
+            return
+        if text == "start":
+            if g.onVote:
+                yield reply("上一次投票还没结束")
+                return
+            g.start_vote()
+            yield self.changed(key)
+            yield reply("法官开启了投票，请私聊bot #vote x表示向x号投票(其中vote 0表示弃票，一经投票不能修改)")
+        elif text == "pk":
+            if g.onVote:
+                yield reply("上一次投票还没结束")
+                return
+            if not g.start_runoff():
+                yield reply("上一轮投票没有平票")
+                return
+            yield self.changed(key)
+            yield reply(f"法官开启了PK投票，{g.round.candidates}号不能投票，其余玩家请私聊bot #vote x在{g.round.candidates}号中选择(vote 0表示弃票)")
+        elif text == "end":
+            if not g.onVote:
+                yield reply("未开启投票")
+                return
+            r = g.end_vote()
+            yield self.changed(key)
+            yield reply(r.describe())
+        elif text == "sheriff":
+            try:
+                pos = int(args[1])
+                if not (0 <= pos <= g.player_num) or not g.alive[pos]:
+                    raise ValueError
+            except (IndexError, ValueError):
+                yield reply("用法：#vote sheriff x，x为存活玩家的位置，0表示撤销警长")
+                return
+            g.sheriff = pos
+            yield self.changed(key)
+            yield reply(f"{pos}号成为警长" if pos else "已撤销警长")
+        else:
+            yield reply(VOTE_USAGE)
+
+    def ballot(self, key, g, pos, text):
+        if g is None:
+            yield reply("你没有加入游戏")
+            return
+        if not g.running:
+            yield reply("游戏未开始")
+            return
+        if not g.onVote:
+            yield reply("未开启投票")
+            return
+        r = g.round
+        try:
+            text = int(text)
+            if text < 0 or text > g.player_num:
+                raise ValueError
+        except ValueError:
+            yield reply(VOTE_USAGE)
+            return
+        if pos == 0:
+            if not g.alive[text]:
+                yield reply(f"{text}号已经死了")
+                return
+            if not r.remove(text):
+                yield reply(f"{text}号没有投票")
+                return
+            yield self.changed(key)
+            yield ('private', g.player[text], "您的票被法官删除")
+            yield reply(f"{text}号的票已被删除,还有{r.not_voted()}号没投票")
+            return
+        if not g.alive[pos]:
+            yield reply("你已经死了")
+            return
+        if not r.can_vote(pos):
+            yield reply("本轮你不能投票")
+            return
+        if not g.alive[text] and text > 0:
+            yield reply(f"{text}号已经死了")
+            return
+        if not r.can_target(text):
+            yield reply(f"本轮只能投给{r.candidates}号")
+            return
+        if not r.cast(pos, text):
+            yield reply("你已经投过票了")
+            return
+        yield self.changed(key)
+        yield reply(f"{pos}->{text}")
+        if g.auto is None:
+            yield ('private', g.player[0], f"{pos}号投给{text}号，还有{r.not_voted()}号没有投票")
+        else:
+            yield from self.moderate(key, g, g.auto.voted(g))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('werewolf.dispatch')
+
+
+class RateLimiter:
+    """Token bucket, rate tokens per second with at most burst saved up."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def full(self):
+        """Whether the bucket has refilled, so a fresh one would behave the same."""
+        return not self._lock.locked() and \
+            self._tokens + (time.monotonic() - self._last) * self.rate >= self.burst
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Dispatcher:
+    """Fans private messages out concurrently, limited per bot account."""
+
+    def __init__(self, send, concurrency=16, rate=20, retries=2, retry_delay=1.0):
+        self.send = send
+        self.rate = rate
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiters = {}
+
+    def _limiter(self, account):
+        if account not in self._limiters:
+            self._limiters[account] = RateLimiter(self.rate)
+        return self._limiters[account]
+
+    async def _deliver(self, account, uid, message):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * attempt)
+            await self._limiter(account).acquire()
+            try:
+                async with self._semaphore:
+                    await self.send(account, uid, message)
+                return True
+            except Exception as e:
+                logger.warning(f"private message to {uid} failed "
+                               f"(attempt {attempt + 1}/{self.retries + 1}): {e!r}")
+        return False
+
+    async def send_all(self, account, messages):
+        """messages is a list of (uid, message); returns the uids that never got theirs."""
+        result = await asyncio.gather(
+            *[self._deliver(account, uid, message) for uid, message in messages])
+        return [uid for (uid, _), ok in zip(messages, result) if not ok]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import os
+import time
+
+
+def encode(one):
+    return (json.dumps(one, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def ranges(data):
+    """(game, group, start, end) of every whole line of index data."""
+    for line in data.splitlines():
+        try:
+            game, group, start, end = json.loads(line)
+        except ValueError:
+            continue
+        yield game, group, start, end
+
+
+def read(path, group_id, offset, end, limit):
+    """Up to limit entries of group_id from offset on, stopping at end, and the offset after them."""
+    entries = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while offset < end and len(entries) < limit:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            try:
+                one = json.loads(line)
+            except ValueError:
+                continue
+            if one[1] == group_id:
+                entries.append(one)
+    return entries, offset
+
+
+class EventLog:
+    """
+    Append-only log of every table mutation, one compact json array per
+    line: [time, group, entry...]. append() only queues; queued lines are
+    written together once per interval on a worker thread, like the
+    Journal. The lines of one table from the end of its last game (or its
+    first line) up to the end of the next form that game's timeline; its
+    byte range goes to path.idx as [game, group, start, end], an open range
+    as [null, group, start, null], so replay() seeks straight to it.
+    A 'remove' or 'abort' entry closes the range without a game.
+    """
+
+    def __init__(self, path, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self._queue = []
+        self._task = None
+        self._open = None
+        # game -> (group, start, end) of this log, and of other shards' logs
+        # with how far into their index each has been read
+        self._games = None
+        self._others = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='werewolf-events')
+
+    def append(self, group_id, entry):
+        self._queue.append((group_id, [int(time.time()), group_id] + list(entry)))
+        self._schedule()
+
+    def close(self, group_id, game_id=None, result=''):
+        """Ends the table's current range, as the timeline of game_id with an 'end' entry."""
+        if game_id is not None:
+            self._queue.append((group_id, [int(time.time()), group_id, 'end', None, result]))
+        self._queue.append((group_id, game_id))
+        self._schedule()
+
+    def _schedule(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().call_later(
+                self.interval, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        self._task = None
+        if not self._queue:
+            return
+        queue, self._queue = self._queue, []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, queue)
+
+    def _recover(self):
+        # ranges still open when the bot stopped continue where they were
+        self._open = {}
+        self._games = {}
+        if not os.path.exists(self.path + '.idx'):
+            return
+        with open(self.path + '.idx', 'rb') as f:
+            for game, group, start, end in ranges(f.read()):
+                if end is None:
+                    self._open[group] = start
+                else:
+                    self._open.pop(group, None)
+                    if game is not None:
+                        self._games[game] = (group, start, end)
+
+    def _write(self, queue):
+        if not queue:
+            return
+        if self._open is None:
+            self._recover()
+        lines = []
+        index = []
+        with open(self.path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for group_id, one in queue:
+                if isinstance(one, list):
+                    if group_id not in self._open:
+                        self._open[group_id] = offset
+                        index.append(encode([None, group_id, offset, None]))
+                    line = encode(one)
+                    lines.append(line)
+                    offset += len(line)
+                    if one[2] not in ('remove', 'abort'):
+                        continue
+                    one = None
+                start = self._open.pop(group_id, None)
+                if start is not None:
+                    index.append(encode([one, group_id, start, offset]))
+                    if one is not None:
+                        self._games[one] = (group_id, start, offset)
+            f.write(b''.join(lines))
+        if index:
+            with open(self.path + '.idx', 'ab') as f:
+                f.write(b''.join(index))
+
+    def _locate(self, path, game_id):
+        """(group, start, end) of a finished game in the log at path, or None."""
+        if path == self.path:
+            if self._games is None:
+                self._recover()
+            return self._games.get(game_id)
+        # other shards append to theirs meanwhile, read on from where we stopped
+        read, games = self._others.setdefault(path, [0, {}])
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as f:
+                f.seek(read)
+                data = f.read()
+            data = data[:data.rfind(b'\n') + 1]
+            for game, group, start, end in ranges(data):
+                if game is not None and end is not None:
+                    games[game] = (group, start, end)
+            self._others[path][0] = read + len(data)
+        return games.get(game_id)
+
+    async def replay(self, game_id, paths=(), chunk=30):
+        """
+        Yields the timeline of game_id chunk entries at a time, reading the
+        log piece by piece on the worker thread. paths are other logs (of
+        other shards) to look in too. Yields nothing if the game is unknown.
+        """
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        for path in (self.path,) + tuple(paths):
+            found = await loop.run_in_executor(self._executor, self._locate, path, game_id)
+            if found is not None:
+                break
+        else:
+            return
+        group_id, offset, end = found
+        while offset < end:
+            entries, offset = await loop.run_in_executor(
+                self._executor, read, path, group_id, offset, end, chunk)
+            if not entries:
+                break
+            yield entries
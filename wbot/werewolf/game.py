@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from array import array
+from functools import lru_cache
+from wbot.werewolf.auto import Moderator
+from wbot.werewolf.vote import VoteRound
+import random
+import time
+
+SHERIFF_WEIGHT = 1.5
+
+
+def cq_at(uid):
+    return f"[CQ:at,qq={uid}]"
+
+
+@lru_cache(maxsize=1024)
+def composition(role, sep="，"):
+    parts = []
+    las = ""
+    last_cnt = 0
+    for name, camp in role:
+        if name != las or last_cnt == 0:
+            if last_cnt > 1:
+                parts.append(f"*{last_cnt}")
+            if last_cnt > 0:
+                parts.append(sep)
+            last_cnt = 1
+            las = name
+            parts.append(las)
+        else:
+            last_cnt += 1
+    if last_cnt > 1:
+        parts.append(f"*{last_cnt}")
+    return "".join(parts)
+
+
+class Game:
+    """
+    One table. Seat 0 is the judge, or stays empty when auto holds the
+    Moderator that runs the game instead. player/identity/alive are compact
+    per-seat arrays, seat maps uid -> seat, and free / alive_count are kept
+    up to date so seat and vote checks never scan the table. round is the
+    open VoteRound, last the most recently closed one. lines caches each
+    seat's line of preview() until that seat changes.
+    """
+
+    __slots__ = ('player_num', 'roleid', 'role', 'player', 'seat', 'free',
+                 'identity', 'alive', 'alive_count', 'running', 'online',
+                 'round', 'last', 'sheriff', 'deaths', 'votes', 'active',
+                 'lines', 'auto', 'account')
+
+    def __init__(self):
+        self.player_num = 0
+        self.roleid = 0
+        self.role = ()
+        self.player = array('q')
+        self.seat = {}
+        self.free = 0
+        self.identity = array('b')
+        self.alive = bytearray()
+        self.alive_count = 0
+        self.running = False
+        self.online = False
+        self.round = None
+        self.last = None
+        self.sheriff = 0
+        self.deaths = []
+        self.votes = []
+        self.active = time.time()
+        self.lines = []
+        self.auto = None
+        # self_id of the bot account the table is played through
+        self.account = None
+
+    def empty(self, uid=-1):
+        return len(self.seat) == 0 or (len(self.seat) == 1 and uid in self.seat)
+
+    def full(self):
+        return self.free == (0 if self.auto is None else 1)
+
+    def seat_of(self, uid):
+        return self.seat.get(uid)
+
+    def init(self, role, identities, online=True, auto=False):
+        self.role = tuple(identities)
+        self.auto = Moderator() if auto else None
+        self.online = online
+        self.roleid = role
+        self.player_num = len(self.role)
+        self.identity = array('b')
+        self.running = False
+        self.clear()
+
+    def clear(self):
+        self.player = array('q', bytes(8 * (self.player_num+1)))
+        self.seat = {}
+        self.free = self.player_num+1
+        self.alive = bytearray(b'\x01' * (self.player_num+1))
+        self.alive_count = self.player_num
+        self.running = False
+        self.round = None
+        self.last = None
+        self.sheriff = 0
+        self.deaths = []
+        self.votes = []
+        self.lines = [None] * (self.player_num+1)
+        if self.auto is not None:
+            self.auto = Moderator()
+
+    @property
+    def onVote(self):
+        return self.round is not None
+
+    def alive_seats(self):
+        return [i for i in range(1, self.player_num+1) if self.alive[i]]
+
+    def sit(self, uid, pos):
+        if pos > self.player_num or pos < 0:
+            return "位置在[0..人数]之间"
+        if pos == 0 and self.auto is not None:
+            return "本桌由bot主持，没有法官位"
+        if uid in self.seat:
+            return "你已经加入了"
+        if self.player[pos] != 0:
+            return "这个位置有人了"
+        self.player[pos] = uid
+        self.seat[uid] = pos
+        self.free -= 1
+        self.lines[pos] = None
+        return ""
+
+    def stand(self, uid):
+        if uid not in self.seat:
+            return "你没有加入"
+        if self.running:
+            return "游戏已经开始"
+        pos = self.seat.pop(uid)
+        self.player[pos] = 0
+        self.free += 1
+        self.lines[pos] = None
+        return ""
+
+    def kick(self, pos):
+        if pos > self.player_num or pos < 0:
+            return (False, "位置在[0..人数]之间")
+        if self.running:
+            return (False, "游戏已经开始")
+        if self.player[pos] == 0:
+            return (False, "这个位置没有人")
+        uid = self.player[pos]
+        self.player[pos] = 0
+        del self.seat[uid]
+        self.free += 1
+        self.lines[pos] = None
+        return (True, uid)
+
+    def kill(self, pos):
+        if not self.alive[pos]:
+            return False
+        self.alive[pos] = 0
+        self.alive_count -= 1
+        self.deaths.append(pos)
+        self.lines[pos] = None
+        if self.round is not None:
+            self.round.drop(pos)
+        return True
+
+    def weights(self):
+        if self.sheriff and self.alive[self.sheriff]:
+            return {self.sheriff: SHERIFF_WEIGHT}
+        return {}
+
+    def start_vote(self):
+        self.round = VoteRound(self.alive_seats(), None, self.weights())
+
+    def start_runoff(self):
+        if self.last is None or len(self.last.leaders()) < 2:
+            return False
+        self.round = self.last.runoff(self.alive_seats())
+        return True
+
+    def end_vote(self):
+        r = self.round
+        self.round = None
+        self.last = r
+        self.votes.append(r.ballots())
+        return r
+
+    def line(self, i):
+        if self.lines[i] is None:
+            s = f"{i}(法官): " if i == 0 else f"{i}: "
+            s += "空" if self.player[i] == 0 else cq_at(self.player[i])
+            if self.running and not self.alive[i]:
+                s += "「已死亡」"
+            self.lines[i] = s + "\n"
+        return self.lines[i]
+
+    def preview(self):
+        return "".join(["游戏已开始，" if self.running else "",
+                        "本桌由bot主持，" if self.auto is not None else "",
+                        "配置为：", composition(self.role), "\n人员为：\n",
+                        *[self.line(i) for i in range(0 if self.auto is None else 1,
+                                                      self.player_num+1)],
+                        "为获取身份，请添加bot为好友。"])
+
+    def generate(self):
+        identity = list(range(self.player_num))
+        random.shuffle(identity)
+        self.identity = array('b', identity)
+        self.running = True
+        self.lines = [None] * (self.player_num+1)
+
+    def dump(self):
+        return {
+            'roleid': self.roleid,
+            'role': self.role,
+            'player': self.player.tolist(),
+            'identity': self.identity.tolist(),
+            'alive': [bool(one) for one in self.alive],
+            'running': self.running,
+            'online': self.online,
+            'round': None if self.round is None else self.round.dump(),
+            'last': None if self.last is None else self.last.dump(),
+            'sheriff': self.sheriff,
+            'deaths': self.deaths,
+            'votes': self.votes,
+            'active': self.active,
+            'auto': None if self.auto is None else self.auto.dump(),
+            'account': self.account,
+        }
+
+    @classmethod
+    def load(cls, state):
+        g = cls()
+        g.roleid = state['roleid']
+        g.role = tuple(tuple(one) for one in state['role'])
+        g.player_num = len(g.role)
+        g.player = array('q', state['player'])
+        g.seat = {uid: pos for pos, uid in enumerate(g.player) if uid != 0}
+        g.free = g.player_num+1 - len(g.seat)
+        g.identity = array('b', state['identity'])
+        g.alive = bytearray(1 if one else 0 for one in state['alive'])
+        g.alive_count = sum(g.alive[1:])
+        g.running = state['running']
+        g.online = state['online']
+        if state.get('round') is not None:
+            g.round = VoteRound.load(state['round'])
+        if state.get('last') is not None:
+            g.last = VoteRound.load(state['last'])
+        g.sheriff = state.get('sheriff', 0)
+        g.deaths = state.get('deaths', [])
+        g.votes = state.get('votes', [])
+        g.active = state.get('active', g.active)
+        g.account = state.get('account')
+        g.lines = [None] * (g.player_num+1)
+        if state.get('auto') is not None:
+            g.auto = Moderator.load(state['auto'])
+        return g
+
+    def record(self):
+        participants = []
+        for i in range(self.player_num):
+            name, camp = self.role[self.identity[i]]
+            death = self.deaths.index(i+1)+1 if i+1 in self.deaths else None
+            participants.append((self.player[i+1], i+1, name, camp, death))
+        return self.player[0], participants, self.votes
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger('werewolf.journal')
+
+
+class Journal:
+    """
+    Line-delimited json journal of table snapshots, one line per changed table.
+    mark() only remembers which tables are dirty; they are serialized and
+    appended together once per interval on a worker thread, and the file is
+    rewritten down to one line per table whenever it grows past compact_after.
+    """
+
+    def __init__(self, path, dump, groups, interval=0.5, compact_after=10000):
+        self.path = path
+        self.dump = dump
+        self.groups = groups
+        self.interval = interval
+        self.compact_after = compact_after
+        self._dirty = set()
+        self._task = None
+        self._lines = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='werewolf-journal')
+
+    def load(self):
+        state = {}
+        if not os.path.exists(self.path):
+            return state
+        lines = 0
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    one = json.loads(line)
+                except ValueError:
+                    # a torn last line after a crash
+                    continue
+                if not isinstance(one, dict) or 'group' not in one or 'state' not in one:
+                    logger.warning(f"skipped a malformed line {lines} of {self.path}")
+                    continue
+                if one['state'] is None:
+                    state.pop(one['group'], None)
+                else:
+                    state[one['group']] = one['state']
+        if lines > len(state):
+            self._rewrite(state)
+        else:
+            self._lines = lines
+        return state
+
+    async def restore(self, build):
+        """
+        load() on the worker thread, with build(state) applied to every table
+        there too. Tables build() fails on are logged and left out.
+        """
+        def work():
+            tables = {}
+            for group_id, one in self.load().items():
+                try:
+                    tables[group_id] = build(one)
+                except Exception as e:
+                    logger.error(f"cannot restore the table of group {group_id}: {e!r}")
+            return tables
+        return await asyncio.get_running_loop().run_in_executor(self._executor, work)
+
+    def mark(self, group_id):
+        self._dirty.add(group_id)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().call_later(
+                self.interval, self._schedule_flush)
+
+    def _schedule_flush(self):
+        asyncio.ensure_future(self.flush())
+
+    def _snapshot(self, groups):
+        lines = []
+        for group_id in groups:
+            lines.append(json.dumps({'group': group_id, 'state': self.dump(group_id)},
+                                    ensure_ascii=False, separators=(',', ':')))
+        return lines
+
+    async def flush(self):
+        self._task = None
+        if not self._dirty:
+            return
+        lines = self._snapshot(self._dirty)
+        self._dirty = set()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._append, lines)
+        if self._lines > self.compact_after:
+            await loop.run_in_executor(self._executor, self._rewrite, self._state())
+
+    def _append(self, lines):
+        if not lines:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        self._lines += len(lines)
+
+    def _state(self):
+        state = {}
+        for group_id in self.groups():
+            one = self.dump(group_id)
+            if one is not None:
+                state[group_id] = one
+        return state
+
+    def _rewrite(self, state):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for group_id, one in state.items():
+                f.write(json.dumps({'group': group_id, 'state': one},
+                                   ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._lines = len(state)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from bisect import bisect_left
+import time
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A family of samples in the Prometheus text format. labels(*values)
+    returns the child for one combination of label values; a metric without
+    labels is its own only child. Children are plain objects updated without
+    locks, so each one must only be written from a single thread.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.child()
+        return child
+
+    def selector(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        # copied first, another thread may add a child meanwhile
+        for values, child in sorted(self.children.copy().items()):
+            lines += self.samples(values, child)
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def child(self):
+        return CounterChild()
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def samples(self, values, child):
+        return [f"{self.name}{self.selector(values)} {number(child.value)}"]
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self, values, child):
+        lines = []
+        total = 0
+        for le, n in zip(self.buckets + (float('inf'),), child.counts):
+            total += n
+            lines.append(f"{self.name}_bucket"
+                         f"{self.selector(values, [('le', number(le))])} {total}")
+        lines.append(f"{self.name}_sum{self.selector(values)} {number(child.sum)}")
+        lines.append(f"{self.name}_count{self.selector(values)} {total}")
+        return lines
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets)+1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ('target', 'begin')
+
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.target.observe(time.perf_counter() - self.begin)
+
+
+class Gauge(Metric):
+    """A value read from func() whenever the metrics are rendered."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, func):
+        super().__init__(name, doc)
+        self.func = func
+
+    def render(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {number(self.func())}"]
+
+
+def render():
+    lines = []
+    for one in registry:
+        lines += one.render()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+def columns(c, table):
+    return [one[1] for one in c.execute(f"pragma table_info({table})").fetchall()]
+
+
+def base(c):
+    c.execute('''create table if not exists roles(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        thief INT DEFAULT 0,
+        del INT
+    )''')
+    c.execute('''create table if not exists roles_alias(
+        id INT NOT NULL,
+        name TEXT NOT NULL
+    )''')
+    c.execute('''create table if not exists roles_identity(
+        id INT NOT NULL,
+        name TEXT NOT NULL,
+        type int NOT NULL
+    )''')
+    c.execute('''create table if not exists game(
+        id INT PRIMARY KEY NOT NULL,
+        group_id INT NOT NULL,
+        role INT NOT NULL,
+        result TEXT
+    )''')
+    c.execute('''create table if not exists game_participant(
+        qq INT NOT NULL,
+        role TEXT NOT NULL,
+        identity TEXT NOT NULL
+    )''')
+    c.execute('''create table if not exists permission(
+        qq INT UNIQUE,
+        permission INT DEFAULT 1
+    )''')
+
+
+def history(c):
+    have = columns(c, 'game_participant')
+    for name, kind in (('game', 'INT'), ('seat', 'INT'), ('camp', 'INT'), ('death', 'INT')):
+        if name not in have:
+            c.execute(f"alter table game_participant add column {name} {kind}")
+    have = columns(c, 'game')
+    for name, kind in (('judge', 'INT'), ('time', 'INT')):
+        if name not in have:
+            c.execute(f"alter table game add column {name} {kind}")
+    c.execute('''create table if not exists game_vote(
+        game INT NOT NULL,
+        round INT NOT NULL,
+        seat INT NOT NULL,
+        target INT NOT NULL
+    )''')
+    c.execute("create index if not exists game_group on game (group_id,id)")
+    c.execute(
+        "create index if not exists game_participant_qq on game_participant (qq,game)")
+    c.execute(
+        "create index if not exists game_participant_game on game_participant (game)")
+    c.execute(
+        "create index if not exists game_vote_game on game_vote (game,round)")
+
+
+def stats(c):
+    backfill = len(c.execute(
+        "select name from sqlite_master where name='user_stats'").fetchall()) == 0
+    c.execute('''create table if not exists user_stats(
+        qq INT NOT NULL,
+        role TEXT NOT NULL,
+        camp INT NOT NULL,
+        games INT NOT NULL DEFAULT 0,
+        decided INT NOT NULL DEFAULT 0,
+        wins INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (qq,role,camp)
+    )''')
+    c.execute('''create table if not exists group_stats(
+        group_id INT NOT NULL,
+        qq INT NOT NULL,
+        games INT NOT NULL DEFAULT 0,
+        decided INT NOT NULL DEFAULT 0,
+        wins INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (group_id,qq)
+    )''')
+    c.execute(
+        "create index if not exists group_stats_rank on group_stats (group_id,wins desc,games)")
+    if backfill:
+        c.execute('''insert into user_stats (qq,role,camp,games,decided,wins)
+            select p.qq,p.role,p.camp,count(*),sum(g.result is not null),
+            sum(g.result is not null and (p.camp=1)=(g.result='好人'))
+            from game_participant p join game g on g.id=p.game
+            where p.camp is not null group by p.qq,p.role,p.camp''')
+        c.execute('''insert into group_stats (group_id,qq,games,decided,wins)
+            select g.group_id,p.qq,count(*),sum(g.result is not null),
+            sum(g.result is not null and (p.camp=1)=(g.result='好人'))
+            from game_participant p join game g on g.id=p.game
+            where p.camp is not null group by g.group_id,p.qq''')
+
+
+def rule_indexes(c):
+    # older databases may hold the same alias twice, keep the first one
+    c.execute('''delete from roles_alias where rowid not in
+        (select min(rowid) from roles_alias group by name)''')
+    c.execute(
+        "create unique index if not exists roles_alias_name on roles_alias (name)")
+    c.execute("create index if not exists roles_alias_id on roles_alias (id)")
+    c.execute(
+        "create index if not exists roles_identity_id on roles_identity (id)")
+
+
+# append only, the position in this list is the schema version
+MIGRATIONS = [base, history, stats, rule_indexes]
+
+
+def migrate(conn):
+    """
+    Brings the schema up to date, one step per transaction. Several shard
+    workers may do this at once: each step takes the write lock first and
+    re-reads the version under it, so a step another process already ran
+    is skipped.
+    """
+    if conn.execute("pragma user_version").fetchone()[0] >= len(MIGRATIONS):
+        return len(MIGRATIONS)
+    while True:
+        c = conn.cursor()
+        c.execute("begin immediate")
+        try:
+            version = c.execute("pragma user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return len(MIGRATIONS)
+            MIGRATIONS[version](c)
+            c.execute(f"pragma user_version={version+1}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from collections import deque
+from wbot.werewolf import metrics
+from wbot.werewolf.dispatch import RateLimiter
+import asyncio
+import time
+
+SENT = metrics.Counter('werewolf_messages_sent_total',
+                       'Messages delivered, after coalescing', ['kind'])
+SEND_FAILURES = metrics.Counter('werewolf_send_failures_total',
+                                'Messages the OneBot API refused or never answered', ['kind'])
+SEND_SECONDS = metrics.Histogram('werewolf_send_seconds',
+                                 'OneBot API time per outgoing message', ['kind'])
+SEND_WAIT = metrics.Histogram('werewolf_send_wait_seconds',
+                              'Time a message spent queued before it was sent', ['kind'])
+
+
+class Outbox:
+    """
+    Every outgoing message goes through here. Each target ((self_id, 'group',
+    id) or (self_id, 'private', id), self_id the bot account to send from, None
+    for whichever is connected) is drained in order by at most one task, consecutive
+    messages waiting for the same target are joined into one, and senders
+    block once max_pending messages are queued.
+    """
+
+    def __init__(self, send, rate=20, group_rate=2, group_burst=5,
+                 max_pending=1000, coalesce_limit=3000):
+        self.send = send
+        self.rate = rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.coalesce_limit = coalesce_limit
+        self._limiters = {}
+        self._group_limiters = {}
+        self._prune_at = 64
+        self._space = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._tasks = set()
+        self.pending = 0
+        self.peak = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def _limiter(self, self_id):
+        # one per bot account, like Dispatcher's
+        if self_id not in self._limiters:
+            self._limiters[self_id] = RateLimiter(self.rate)
+        return self._limiters[self_id]
+
+    def _group_limiter(self, target):
+        if target not in self._group_limiters:
+            if len(self._group_limiters) >= self._prune_at:
+                self._prune()
+            self._group_limiters[target] = RateLimiter(
+                self.group_rate, self.group_burst)
+        return self._group_limiters[target]
+
+    def _prune(self):
+        # limiters of idle groups with a full bucket carry no state
+        for target, limiter in list(self._group_limiters.items()):
+            if target not in self._queues and limiter.full():
+                del self._group_limiters[target]
+        self._prune_at = max(64, 2 * len(self._group_limiters))
+
+    async def put(self, target, message):
+        await self._space.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        self.peak = max(self.peak, self.pending)
+        if target in self._queues:
+            self._queues[target].append((message, future, time.perf_counter()))
+        else:
+            self._queues[target] = deque([(message, future, time.perf_counter())])
+            task = asyncio.create_task(self._drain(target))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        await future
+
+    async def group(self, self_id, group_id, message):
+        await self.put((self_id, 'group', group_id), message)
+
+    async def private(self, self_id, user_id, message):
+        await self.put((self_id, 'private', user_id), message)
+
+    def _take(self, queue):
+        message, future, queued = queue.popleft()
+        futures = [future]
+        while queue and len(message) + 1 + len(queue[0][0]) <= self.coalesce_limit:
+            one, future, _ = queue.popleft()
+            message += '\n' + one
+            futures.append(future)
+        return message, futures, queued
+
+    async def _drain(self, target):
+        queue = self._queues[target]
+        kind = target[1]
+        while queue:
+            message, futures, queued = self._take(queue)
+            await self._limiter(target[0]).acquire()
+            if kind == 'group':
+                await self._group_limiter(target).acquire()
+            begin = time.perf_counter()
+            SEND_WAIT.labels(kind).observe(begin - queued)
+            try:
+                await self.send(target, message)
+                error = None
+                self.sent += 1
+                self.coalesced += len(futures) - 1
+                SENT.labels(kind).inc()
+            except Exception as e:
+                error = e
+                self.failed += 1
+                SEND_FAILURES.labels(kind).inc()
+            SEND_SECONDS.labels(kind).observe(time.perf_counter() - begin)
+            for future in futures:
+                self.pending -= 1
+                self._space.release()
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        del self._queues[target]
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'peak': self.peak,
+            'targets': len(self._queues),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+        }
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from collections import OrderedDict
+import time
+
+
+class PermissionCache:
+    """Bounded LRU of permission levels, entries expire after ttl seconds."""
+
+    def __init__(self, repo, size=4096, ttl=600):
+        self.repo = repo
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def _put(self, uid, level):
+        self._data[uid] = (level, time.monotonic() + self.ttl)
+        self._data.move_to_end(uid)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    async def get(self, uid):
+        one = self._data.get(uid)
+        if one is not None and one[1] > time.monotonic():
+            self._data.move_to_end(uid)
+            return one[0]
+        level = await self.repo.permission(uid)
+        self._put(uid, level)
+        return level
+
+    async def set(self, uid, level):
+        await self.repo.set_permission(uid, level)
+        self._put(uid, level)
+
+    def invalidate(self, uid=None):
+        if uid is None:
+            self._data.clear()
+        else:
+            self._data.pop(uid, None)
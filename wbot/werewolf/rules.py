@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from collections import Counter
+from itertools import chain
+import heapq
+
+# Dice similarity at which a name counts as meant, and at which it is suggested;
+# a close match is taken when no other rule comes within MARGIN of it
+CLOSE = 0.5
+SUGGEST = 0.3
+MARGIN = 0.1
+
+
+def bigrams(name):
+    name = f"\x02{name}\x03"
+    return frozenset(name[i:i+2] for i in range(len(name) - 1))
+
+
+class AliasIndex:
+    """
+    Inverted index from character bigrams to the aliases containing them,
+    kept apart by the aliases' bigram count. Within one count the Dice
+    score only grows with the bigrams shared, so search() ranks each part
+    by a Counter and skips the parts that cannot beat what it has found.
+    """
+
+    def __init__(self, names=()):
+        self.parts = {}
+        self.grams = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if name in self.grams:
+            return
+        grams = self.grams[name] = bigrams(name)
+        part = self.parts.setdefault(len(grams), {})
+        for gram in grams:
+            part.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        grams = self.grams.pop(name, None)
+        if grams is None:
+            return
+        part = self.parts[len(grams)]
+        for gram in grams:
+            part[gram].discard(name)
+            if not part[gram]:
+                del part[gram]
+        if not part:
+            del self.parts[len(grams)]
+
+    def search(self, query, limit=20, floor=0.0):
+        """Up to limit (Dice score, alias) of at least floor, best first."""
+        grams = bigrams(query)
+        total = len(grams)
+        best = []
+        # the best an alias of a size can do is to contain the query or be
+        # contained; parts go in order of that bound, so the first that cannot
+        # reach floor ends the search
+        for size in sorted(self.parts, key=lambda size: -2*min(size, total) / (size + total)):
+            if 2*min(size, total) / (size + total) < floor:
+                break
+            part = self.parts[size]
+            common = Counter(chain.from_iterable(part.get(gram, ()) for gram in grams))
+            if not common or 2*max(common.values()) / (size + total) < floor:
+                continue
+            for name, c in common.most_common(limit):
+                score = 2*c / (size + total)
+                if score < floor:
+                    break
+                if len(best) < limit:
+                    heapq.heappush(best, (score, name))
+                else:
+                    heapq.heappushpop(best, (score, name))
+                if len(best) == limit:
+                    floor = max(floor, best[0][0])
+        return sorted(best, reverse=True)
+
+
+class RuleCache:
+    """Process-wide copy of roles_alias / roles_identity, so #set never touches the db."""
+
+    def __init__(self):
+        self.alias = {}
+        self.identity = {}
+        self.index = AliasIndex()
+
+    def load(self, aliases, identities):
+        alias = {}
+        for _id, name in aliases:
+            alias[name] = _id
+        identity = {}
+        for _id, name, camp in identities:
+            identity.setdefault(_id, []).append((name, camp))
+        identity = {_id: tuple(l) for _id, l in identity.items()}
+        index = AliasIndex(alias)
+        # swap everything in one step, readers never see a half-loaded cache
+        self.alias, self.identity, self.index = alias, identity, index
+
+    def find(self, name):
+        return self.alias.get(name)
+
+    def resolve(self, name, limit=5):
+        """
+        (rule id, []) for an exact name; (rule id, [alias]) when an alias is
+        close to name and no other rule's comes within MARGIN; otherwise
+        (None, up to limit aliases of different rules to suggest, best first).
+        """
+        _id = self.alias.get(name)
+        if _id is not None:
+            return _id, []
+        names = []
+        scores = []
+        seen = set()
+        for score, alias in self.index.search(name, 2*limit, SUGGEST):
+            _id = self.alias[alias]
+            if _id not in seen:
+                seen.add(_id)
+                names.append(alias)
+                scores.append(score)
+        if scores and scores[0] >= CLOSE and (len(scores) == 1 or scores[1] <= scores[0] - MARGIN):
+            return self.alias[names[0]], names[:1]
+        return None, names[:limit]
+
+    def identities(self, rule_id):
+        return self.identity.get(rule_id, ())
+
+    def aliases(self, rule_id):
+        return [name for name, _id in self.alias.items() if _id == rule_id]
+
+    def alias_conflict(self, rule_id, names):
+        for i in names:
+            _id = self.alias.get(i)
+            if _id is not None and _id != rule_id:
+                return True
+        return False
+
+    def add(self, rule_id, name, identities):
+        self.identity[rule_id] = tuple(identities)
+        self.alias[name] = rule_id
+        self.index.add(name)
+
+    def set_aliases(self, rule_id, names):
+        for name in self.aliases(rule_id):
+            del self.alias[name]
+            self.index.remove(name)
+        for name in names:
+            self.alias[name] = rule_id
+            self.index.add(name)
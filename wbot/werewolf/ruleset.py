@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+import json
+import re
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# keys of a rule in an import/export file, in camp order (1, 2, 3)
+CAMP_KEYS = ('good', 'wolves', 'hidden')
+MAX_IDENTITIES = 20
+MAX_ERRORS = 10
+
+
+def parse_identities(lists):
+    """
+    Rows (name, camp) of a rule from one list of names per camp, the same
+    name grouped together in order of first appearance. Returns (rows, error).
+    """
+    camp_of = {}
+    count = {}
+    for camp, names in enumerate(lists, 1):
+        for one in names:
+            if camp_of.setdefault(one, camp) != camp:
+                return None, "同一种身份不能在不同阵营中"
+            count[one] = count.get(one, 0) + 1
+    if sum(count.values()) > MAX_IDENTITIES:
+        return None, "😅"
+    rows = []
+    for one, n in count.items():
+        rows += [(one, camp_of[one])] * n
+    return rows, None
+
+
+def split_lists(args):
+    """The comma separated camp lists of #addrole, empty names dropped."""
+    return [[one for one in re.split(",|，", arg) if len(one)] for arg in args]
+
+
+def bad_name(name):
+    return not isinstance(name, str) or not name or re.search(r"\s|,|，", name)
+
+
+def read(text):
+    """Parses an import file, JSON if it starts with '{' and TOML otherwise."""
+    text = text.strip()
+    if text.startswith('{'):
+        try:
+            return json.loads(text), None
+        except ValueError as e:
+            return None, f"JSON格式错误：{e}"
+    if tomllib is None:
+        return None, "没有安装TOML解析库(tomli)，请使用JSON格式"
+    try:
+        return tomllib.loads(text), None
+    except ValueError as e:
+        return None, f"TOML格式错误：{e}"
+
+
+def validate(data, taken):
+    """
+    Checks every rule of a parsed import file before anything is written.
+    taken(name) tells whether a name is already used by an existing rule.
+    Returns (entries, errors), entries as (name, aliases, rows).
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('rules'), list):
+        return [], ["文件中应有一个名为 rules 的规则列表"]
+    entries = []
+    errors = []
+    seen = set()
+    for i, rule in enumerate(data['rules'], 1):
+        where = f"第{i}个规则"
+        if not isinstance(rule, dict):
+            errors.append(f"{where}格式错误")
+            continue
+        name = rule.get('name')
+        aliases = rule.get('aliases', [])
+        if bad_name(name):
+            errors.append(f"{where}的名字不能为空或包含空格、逗号")
+            continue
+        where = f"{where}({name})"
+        if not isinstance(aliases, list) or any(bad_name(one) for one in aliases):
+            errors.append(f"{where}的别名应为不含空格、逗号的名字列表")
+            continue
+        unknown = set(rule) - {'name', 'aliases'} - set(CAMP_KEYS)
+        if unknown:
+            errors.append(f"{where}有未知的字段{sorted(unknown)}")
+            continue
+        lists = [rule.get(key, []) for key in CAMP_KEYS]
+        if any(not isinstance(names, list) or any(bad_name(one) for one in names)
+               for names in lists):
+            errors.append(f"{where}的身份应为不含空格、逗号的名字列表")
+            continue
+        rows, error = parse_identities(lists)
+        if error is None and not rows:
+            error = "没有身份"
+        if error is not None:
+            errors.append(f"{where}：{error}")
+            continue
+        names = list(dict.fromkeys([name] + aliases))
+        clash = [one for one in names if one in seen or taken(one)]
+        if clash:
+            errors.append(f"{where}：{clash}已被使用")
+            continue
+        seen.update(names)
+        entries.append((name, names[1:], rows))
+    return entries, errors
+
+
+def explain(errors):
+    s = "\n".join(errors[:MAX_ERRORS])
+    if len(errors) > MAX_ERRORS:
+        s += f"\n……共{len(errors)}处错误"
+    return s
+
+
+def dump(rules):
+    """A rule file body from (name, aliases, rows) of every rule."""
+    body = []
+    for name, aliases, rows in rules:
+        rule = {'name': name, 'aliases': aliases}
+        for camp, key in enumerate(CAMP_KEYS, 1):
+            rule[key] = [one for one, c in rows if c == camp]
+        body.append(rule)
+    return body
+
+
+def write_json(rules):
+    lines = [json.dumps(rule, ensure_ascii=False) for rule in dump(rules)]
+    return '{"rules": [\n' + ",\n".join(lines) + "\n]}\n"
+
+
+def pieces(text, size):
+    """text cut at line ends into pieces of at most size characters (longer lines stay whole)."""
+    out = []
+    piece = ""
+    for line in text.splitlines(keepends=True):
+        if piece and len(piece) + len(line) > size:
+            out.append(piece)
+            piece = ""
+        piece += line
+    if piece:
+        out.append(piece)
+    return out
+
+
+def write_toml(rules):
+    # only strings and lists of strings, whose JSON spelling is valid TOML
+    out = []
+    for rule in dump(rules):
+        out.append("[[rules]]")
+        for key, value in rule.items():
+            out.append(f"{key} = {json.dumps(value, ensure_ascii=False)}")
+        out.append("")
+    return "\n".join(out)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import sqlite3
+
+PRAGMAS = ('journal_mode=WAL', 'synchronous=OFF', 'busy_timeout=5000')
+logger = logging.getLogger('werewolf.shard')
+
+
+class SeatIndex:
+    """
+    Which group every seated user sits in, across all shards, kept in a small
+    SQLite file that each worker and the supervisor open. It can always be
+    rebuilt from the workers' journals, so writes are not synced. Also holds
+    version counters a shard bumps after changing data other shards cache;
+    'seats' is bumped with every seat change. The file is opened on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None,
+                                   check_same_thread=False)
+            for one in PRAGMAS:
+                conn.execute(f"pragma {one}")
+            conn.execute('''create table if not exists seat(
+                qq INTEGER PRIMARY KEY NOT NULL,
+                group_id INT NOT NULL
+            )''')
+            conn.execute('''create table if not exists version(
+                name TEXT PRIMARY KEY NOT NULL,
+                value INT NOT NULL
+            )''')
+            self._conn = conn
+        return self._conn
+
+    def get(self, uid):
+        row = self.conn.execute("select group_id from seat where qq=?",
+                                (uid,)).fetchone()
+        return None if row is None else row[0]
+
+    def _seats_changed(self, sql, args=(), many=False):
+        conn = self.conn
+        conn.execute("begin")
+        try:
+            (conn.executemany if many else conn.execute)(sql, args)
+            self._bump(conn, 'seats')
+            conn.execute("commit")
+        except BaseException:
+            conn.execute("rollback")
+            raise
+
+    def set(self, uid, group_id):
+        self._seats_changed("insert or replace into seat (qq,group_id) values (?,?)",
+                            (uid, group_id))
+
+    def discard(self, uid, group_id):
+        self._seats_changed("delete from seat where qq=? and group_id=?",
+                            (uid, group_id))
+
+    def publish(self, seats):
+        self._seats_changed("insert or replace into seat (qq,group_id) values (?,?)",
+                            seats, many=True)
+
+    def reset(self):
+        self._seats_changed("delete from seat")
+
+    def version(self, name):
+        row = self.conn.execute("select value from version where name=?",
+                                (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def data_version(self):
+        """Changes whenever another connection commits to the file."""
+        return self.conn.execute("pragma data_version").fetchone()[0]
+
+    def versions(self):
+        return dict(self.conn.execute("select name,value from version").fetchall())
+
+    def seats(self):
+        return dict(self.conn.execute("select qq,group_id from seat").fetchall())
+
+    @staticmethod
+    def _bump(conn, name):
+        conn.execute('''insert into version (name,value) values (?,1)
+            on conflict (name) do update set value=value+1''', (name,))
+
+    def bump(self, name):
+        """Bumps the counter name, returns its new value."""
+        self._bump(self.conn, name)
+        return self.version(name)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class IndexMirror:
+    """
+    A view of the SeatIndex that never touches SQLite on the event loop:
+    changes are queued to a worker thread without waiting, like the journal,
+    and the version counters (and, when 'seats' moved, the whole seat map)
+    are polled every interval into memory, so get() and version() are dict
+    lookups. A poll finds nothing to read unless another process has
+    committed since, so the interval can be short; counters bumped here are
+    updated as soon as the write lands.
+    """
+
+    def __init__(self, index, interval=0.1):
+        self.index = index
+        self.interval = interval
+        self.seats = {}
+        self.versions = {}
+        self._seen = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='werewolf-seats')
+
+    def _write(self, method, *args):
+        done = self._executor.submit(method, *args)
+        done.add_done_callback(self._written)
+        return done
+
+    @staticmethod
+    def _written(done):
+        if done.exception() is not None:
+            logger.error(f"seat index write failed: {done.exception()!r}")
+
+    def set(self, uid, group_id):
+        self._write(self.index.set, uid, group_id)
+
+    def discard(self, uid, group_id):
+        self._write(self.index.discard, uid, group_id)
+
+    def publish(self, seats):
+        self._write(self.index.publish, seats)
+
+    def bump(self, name):
+        loop = asyncio.get_running_loop()
+
+        def bumped(done):
+            if done.exception() is None:
+                loop.call_soon_threadsafe(self._update, {name: done.result()})
+        self._write(self.index.bump, name).add_done_callback(bumped)
+
+    async def reset(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.index.reset)
+        self.seats = {}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.index.close)
+
+    def get(self, uid):
+        return self.seats.get(uid)
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def _update(self, versions):
+        # a poll read before a bump here landed must not take it back
+        self.versions = dict(self.versions, **{name: max(value, self.versions.get(name, 0))
+                                               for name, value in versions.items()})
+
+    def _poll(self, seen, seats_version):
+        version = self.index.data_version()
+        if version == seen:
+            return version, None, None
+        versions = self.index.versions()
+        seats = self.index.seats() if versions.get('seats', 0) != seats_version else None
+        return version, versions, seats
+
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._seen, versions, seats = await loop.run_in_executor(
+                    self._executor, self._poll, self._seen,
+                    self.versions.get('seats', 0) if self.seats else None)
+                if seats is not None:
+                    self.seats = seats
+                if versions is not None:
+                    self._update(versions)
+            except Exception as e:
+                logger.error(f"cannot read the seat index: {e!r}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.poll())
+
+
+class InGame(dict):
+    """
+    in_game of one shard. Changes are mirrored to the IndexMirror, and get()
+    also finds users seated on other shards (groups mine() is false for) so
+    "already in another group" checks still hold. Without an index it is a
+    plain dict.
+    """
+
+    def __init__(self, index=None, mine=None):
+        super().__init__()
+        self.index = index
+        self.mine = mine
+
+    def __setitem__(self, uid, group_id):
+        super().__setitem__(uid, group_id)
+        if self.index is not None:
+            self.index.set(uid, group_id)
+
+    def __delitem__(self, uid):
+        self.pop(uid)
+
+    def pop(self, uid, *default):
+        if not dict.__contains__(self, uid):
+            return super().pop(uid, *default)
+        group_id = super().pop(uid)
+        if self.index is not None:
+            self.index.discard(uid, group_id)
+        return group_id
+
+    def restore(self, seats):
+        seats = list(seats)
+        super().update(seats)
+        if self.index is not None:
+            self.index.publish(seats)
+
+    def get(self, uid, default=None):
+        group_id = super().get(uid)
+        if group_id is None and self.index is not None:
+            group_id = self.index.get(uid)
+            # this shard's own seats are only ever the ones in the dict
+            if group_id is not None and self.mine is not None and self.mine(group_id):
+                group_id = None
+        return default if group_id is None else group_id
+
+
+def route(payload, shards, index):
+    """
+    Shards an event is handed to. Group events go to the group's shard,
+    private ones to the shard of the group the user sits in, or else by
+    user id; meta events (heartbeats, lifecycle) go to every shard.
+    """
+    if payload.get('post_type') == 'meta_event':
+        return range(shards)
+    key = payload.get('group_id')
+    if not key and payload.get('user_id'):
+        key = index.get(payload['user_id']) or payload['user_id']
+    return (int(key or 0) % shards,)
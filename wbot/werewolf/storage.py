@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from concurrent.futures import ThreadPoolExecutor
+from wbot.werewolf import metrics
+from wbot.werewolf.migrations import migrate
+import asyncio
+import sqlite3
+import time
+
+CAMPS = {1: '好人', 2: '狼人', 3: '狼人(夜里不见面)'}
+# busy_timeout first, switching to WAL needs the lock too
+PRAGMAS = ('busy_timeout=5000', 'journal_mode=WAL', 'synchronous=NORMAL',
+           'temp_store=MEMORY', 'cache_size=-16000')
+QUERY_SECONDS = metrics.Histogram('werewolf_db_query_seconds',
+                                  'Time werewolf.db spends on each query, commit included', ['query'])
+QUERY_ERRORS = metrics.Counter('werewolf_db_query_errors_total',
+                               'werewolf.db queries that failed and were rolled back', ['query'])
+
+
+class Repository:
+    """All werewolf.db access, run on one worker thread so the event loop never waits on disk."""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._opened = None
+        self._migrated = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='werewolf-db')
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            for one in PRAGMAS:
+                conn.execute(f"pragma {one}")
+            self._conn = conn
+        return self._conn
+
+    def _migrate(self):
+        migrate(self._connect())
+        self._migrated = True
+
+    def _call(self, func, args):
+        # a failed migration (say, the file was locked) is tried again
+        if self._opened is not None and not self._migrated:
+            self._migrate()
+        # metrics are only ever written from this worker thread
+        query = func.__name__.lstrip('_')
+        conn = self._connect()
+        with QUERY_SECONDS.labels(query).time():
+            try:
+                result = func(conn.cursor(), *args)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                QUERY_ERRORS.labels(query).inc()
+                raise
+        return result
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, func, args)
+
+    def run_sync(self, func, *args):
+        return self.submit(func, *args).result()
+
+    def submit(self, func, *args):
+        return self._executor.submit(self._call, func, args)
+
+    def prepare(self):
+        return self.open().result()
+
+    def open(self):
+        """
+        Connect and migrate on the worker thread without waiting for it.
+        Queries submitted afterwards queue up behind; if it failed, each
+        of them tries it again first and fails with its error.
+        """
+        if self._opened is None:
+            self._opened = self._executor.submit(self._migrate)
+        return self._opened
+
+    def close(self):
+        if self._conn is not None:
+            self._executor.submit(self._conn.close).result()
+            self._conn = None
+        self._executor.shutdown()
+
+    @staticmethod
+    def _load_rules(c):
+        aliases = c.execute("select id,name from roles_alias").fetchall()
+        identities = c.execute(
+            "select id,name,type from roles_identity order by rowid").fetchall()
+        return aliases, identities
+
+    @staticmethod
+    def _permission(c, uid):
+        l = c.execute("select permission from permission where qq=?",
+                      (uid,)).fetchall()
+        if len(l) == 0:
+            return 0
+        return l[0][0]
+
+    @staticmethod
+    def _set_permission(c, uid, level):
+        if level == 0:
+            c.execute("delete from permission where qq=?", (uid,))
+        else:
+            c.execute("insert or replace into permission (qq,permission) values (?,?)",
+                      (uid, level))
+
+    @staticmethod
+    def _record_game(c, group_id, rule_id, judge, participants, votes, winner):
+        # other shards may be writing games too, take the write lock before picking the id
+        c.execute("begin immediate")
+        _id = c.execute("select coalesce(max(id),0)+1 from game").fetchone()[0]
+        c.execute("insert into game (id,group_id,role,result,judge,time) values (?,?,?,?,?,?)",
+                  (_id, group_id, rule_id, CAMPS.get(winner), judge, int(time.time())))
+        c.executemany("insert into game_participant (game,qq,seat,role,identity,camp,death) values (?,?,?,?,?,?,?)",
+                      [(_id, qq, seat, name, CAMPS.get(camp, ''), camp, death)
+                       for qq, seat, name, camp, death in participants])
+        c.executemany("insert into game_vote (game,round,seat,target) values (?,?,?,?)",
+                      [(_id, r+1, seat, target)
+                       for r in range(len(votes)) for seat, target in votes[r]])
+        result = []
+        for qq, seat, name, camp, death in participants:
+            decided = 0 if winner is None else 1
+            win = 1 if decided and (camp == 1) == (winner == 1) else 0
+            result.append((qq, name, camp, decided, win))
+        c.executemany('''insert into user_stats (qq,role,camp,games,decided,wins) values (?,?,?,1,?,?)
+            on conflict (qq,role,camp) do update set
+            games=games+1, decided=decided+excluded.decided, wins=wins+excluded.wins''',
+                      result)
+        c.executemany('''insert into group_stats (group_id,qq,games,decided,wins) values (?,?,1,?,?)
+            on conflict (group_id,qq) do update set
+            games=games+1, decided=decided+excluded.decided, wins=wins+excluded.wins''',
+                      [(group_id, qq, decided, win) for qq, name, camp, decided, win in result])
+        return _id
+
+    @staticmethod
+    def _played(c, game_id, qq):
+        return bool(c.execute("select 1 from game where id=? and judge=? union all "
+                              "select 1 from game_participant where game=? and qq=? limit 1",
+                              (game_id, qq, game_id, qq)).fetchall())
+
+    @staticmethod
+    def _user_stats(c, qq):
+        return c.execute("select role,camp,games,decided,wins from user_stats where qq=? order by games desc",
+                         (qq,)).fetchall()
+
+    @staticmethod
+    def _group_rank(c, group_id, limit):
+        return c.execute("select qq,games,decided,wins from group_stats where group_id=? order by wins desc,games limit ?",
+                         (group_id, limit)).fetchall()
+
+    @staticmethod
+    def _add_rule(c, name, identities):
+        c.execute("insert into roles (name) values (?)", (name,))
+        _id = c.lastrowid
+        c.execute("insert into roles_alias (id,name) values (?,?)", (_id, name))
+        c.executemany("insert into roles_identity (id,name,type) values (?,?,?)",
+                      [(_id, one, camp) for one, camp in identities])
+        return _id
+
+    @staticmethod
+    def _replace_aliases(c, rule_id, name, aliases):
+        c.execute("delete from roles_alias where id=?", (rule_id,))
+        al = [c.execute("select name from roles where id=?",
+                        (rule_id,)).fetchall()[0][0]]
+        if al[0] != name:
+            al.append(name)
+        for i in aliases:
+            if not i in al:
+                al.append(i)
+        c.executemany("insert into roles_alias (id,name) values (?,?)",
+                      [(rule_id, i) for i in al])
+        return al
+
+    @staticmethod
+    def _import_rules(c, entries):
+        # ids are handed out up front so every table takes one executemany;
+        # begin immediate keeps other shards from taking the same ids meanwhile
+        c.execute("begin immediate")
+        first = c.execute("select coalesce(max(id),0) from roles").fetchone()[0] + 1
+        ids = range(first, first + len(entries))
+        c.executemany("insert into roles (id,name) values (?,?)",
+                      [(_id, name) for _id, (name, aliases, rows) in zip(ids, entries)])
+        c.executemany("insert into roles_alias (id,name) values (?,?)",
+                      [(_id, one) for _id, (name, aliases, rows) in zip(ids, entries)
+                       for one in [name] + aliases])
+        c.executemany("insert into roles_identity (id,name,type) values (?,?,?)",
+                      [(_id, one, camp) for _id, (name, aliases, rows) in zip(ids, entries)
+                       for one, camp in rows])
+        return Repository._load_rules(c)
+
+    @staticmethod
+    def _export_rules(c):
+        aliases = {}
+        for _id, name in c.execute("select id,name from roles_alias order by rowid"):
+            aliases.setdefault(_id, []).append(name)
+        identities = {}
+        for _id, name, camp in c.execute(
+                "select id,name,type from roles_identity order by rowid"):
+            identities.setdefault(_id, []).append((name, camp))
+        return [(name, [one for one in aliases.get(_id, []) if one != name],
+                 identities.get(_id, []))
+                for _id, name in c.execute("select id,name from roles order by id")]
+
+    async def permission(self, uid):
+        return await self.run(self._permission, uid)
+
+    async def set_permission(self, uid, level):
+        return await self.run(self._set_permission, uid, level)
+
+    async def record_game(self, group_id, rule_id, judge, participants, votes, winner=None):
+        return await self.run(self._record_game, group_id, rule_id, judge, participants, votes, winner)
+
+    async def played(self, game_id, qq):
+        """Whether qq judged or played game game_id."""
+        return await self.run(self._played, game_id, qq)
+
+    async def user_stats(self, qq):
+        return await self.run(self._user_stats, qq)
+
+    async def group_rank(self, group_id, limit):
+        return await self.run(self._group_rank, group_id, limit)
+
+    async def add_rule(self, name, identities):
+        return await self.run(self._add_rule, name, identities)
+
+    async def replace_aliases(self, rule_id, name, aliases):
+        return await self.run(self._replace_aliases, rule_id, name, aliases)
+
+    async def import_rules(self, entries):
+        """Adds (name, aliases, rows) rules in one transaction, returns the reloaded rule tables."""
+        return await self.run(self._import_rules, entries)
+
+    async def export_rules(self):
+        return await self.run(self._export_rules)
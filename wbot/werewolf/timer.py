@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+from math import ceil
+import asyncio
+import logging
+
+logger = logging.getLogger('werewolf.timer')
+
+
+class Timer:
+    __slots__ = ('due', 'callback', 'args')
+
+    def __init__(self, due, callback, args):
+        self.due = due
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. Deadlines are rounded up to whole ticks and hashed
+    into slots by tick number; a single task wakes once per tick, fires what
+    is due in that slot and sleeps again, and stops while nothing is
+    scheduled. Thousands of tables with deadlines cost one sleeping task.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.now = 0
+        self.count = 0
+        self._task = None
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer(self.now + max(1, ceil(delay / self.tick)), callback, args)
+        self.slots[timer.due % len(self.slots)][timer] = None
+        self.count += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return timer
+
+    def cancel(self, timer):
+        if self.slots[timer.due % len(self.slots)].pop(timer, 0) is None:
+            self.count -= 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        origin = loop.time() - self.now * self.tick
+        try:
+            while self.count:
+                self.now += 1
+                await asyncio.sleep(max(0, origin + self.now * self.tick - loop.time()))
+                slot = self.slots[self.now % len(self.slots)]
+                due = [timer for timer in slot if timer.due <= self.now]
+                for timer in due:
+                    del slot[timer]
+                    self.count -= 1
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception:
+                        logger.exception('timer callback failed')
+        finally:
+            self._task = None
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+__author__ = 'QAQAutoMaton'
+
+
+class VoteRound:
+    """
+    One round of voting. Keeps the ballots, the seats still to vote, and for
+    every target both the voters and the weighted tally, so casting, deleting
+    and reading a ballot are all O(1). Target 0 means abstaining.
+    """
+
+    __slots__ = ('voters', 'candidates', 'weights', 'ballot', 'pending',
+                 'buckets', 'tally')
+
+    def __init__(self, voters, candidates=None, weights=None):
+        self.voters = list(voters)
+        self.candidates = None if candidates is None else list(candidates)
+        self.weights = dict(weights or {})
+        self.ballot = {}
+        self.pending = dict.fromkeys(self.voters)
+        self.buckets = {}
+        self.tally = {}
+
+    def weight(self, seat):
+        return self.weights.get(seat, 1)
+
+    def can_vote(self, seat):
+        return seat in self.pending or seat in self.ballot
+
+    def can_target(self, target):
+        return target == 0 or self.candidates is None or target in self.candidates
+
+    def cast(self, seat, target):
+        if seat not in self.pending:
+            return False
+        del self.pending[seat]
+        self.ballot[seat] = target
+        self.buckets.setdefault(target, {})[seat] = None
+        self.tally[target] = self.tally.get(target, 0) + self.weight(seat)
+        return True
+
+    def remove(self, seat):
+        if seat not in self.ballot:
+            return False
+        target = self.ballot.pop(seat)
+        del self.buckets[target][seat]
+        self.tally[target] -= self.weight(seat)
+        if not self.buckets[target]:
+            del self.buckets[target]
+            del self.tally[target]
+        self.pending[seat] = None
+        return True
+
+    def drop(self, seat):
+        self.remove(seat)
+        self.pending.pop(seat, None)
+
+    def not_voted(self):
+        return sorted(self.pending)
+
+    def result(self):
+        """[(target, tally, voters)], pending voters count as abstaining."""
+        buckets = {target: sorted(seats) for target, seats in self.buckets.items()}
+        tally = dict(self.tally)
+        if self.pending:
+            buckets[0] = sorted(buckets.get(0, []) + list(self.pending))
+            tally[0] = tally.get(0, 0) + \
+                sum(self.weight(seat) for seat in self.pending)
+        return [(target, tally[target], buckets[target]) for target in sorted(buckets)]
+
+    def ballots(self):
+        return [(seat, self.ballot.get(seat, 0)) for seat in sorted(self.voters)
+                if seat in self.ballot or seat in self.pending]
+
+    def leaders(self):
+        tally = {target: w for target, w in self.tally.items() if target != 0}
+        if not tally:
+            return []
+        top = max(tally.values())
+        return sorted(target for target, w in tally.items() if w == top)
+
+    def runoff(self, alive):
+        """PK round between the tied leaders; they speak, everyone else alive votes."""
+        leaders = self.leaders()
+        voters = [seat for seat in alive if seat not in leaders]
+        return VoteRound(voters, leaders, self.weights)
+
+    def describe(self):
+        text = "投票结果：\n"
+        for target, tally, voters in self.result():
+            text += f"{target} <- {voters}"
+            if tally != len(voters):
+                text += f" 共{tally:g}票"
+            text += "\n"
+        return text[:-1]
+
+    def dump(self):
+        return {
+            'voters': self.voters,
+            'candidates': self.candidates,
+            'weights': list(self.weights.items()),
+            'ballot': list(self.ballot.items()),
+        }
+
+    @classmethod
+    def load(cls, state):
+        r = cls(state['voters'], state['candidates'], dict(
+            (seat, w) for seat, w in state['weights']))
+        for seat, target in state['ballot']:
+            r.cast(seat, target)
+        return r